@@ -1,11 +1,29 @@
 # -----------------------------------------------------------
-# This module runs the application.
+# This module runs the application. Without arguments the
+# interactive UI is started, with --config the cities of a
+# YAML config file are processed without user interaction:
+# python -m proj_sp_conradi --config cities.yaml
 #
 #
 # Johannes Conradi, 2020 ETH Zuerich
 # email: conradij@ethz.ch
 # -----------------------------------------------------------
+import sys
+import argparse
 from proj_sp_conradi import app
 
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(prog='python -m proj_sp_conradi',
+                                     description='Generate standardized mobility data sets for cities.')
+    parser.add_argument('--config', help='YAML file with the settings of the cities to process in batch mode')
+    parser.add_argument('--chunksize', type=int, default=100000, help='trips per chunk of the demand file')
+    parser.add_argument('--workers', type=int, default=1, help='processes that map the demand file to OSM nodes')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='layers (of any city) that are processed at the same time')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='processes for the CPU bound layers, by default --concurrency but at most one per CPU')
+    args = parser.parse_args()
+    if args.config:
+        failed = app.run_batch(args.config, args.chunksize, args.workers, args.concurrency, args.processes)
+        sys.exit(1 if failed else 0)
+    app.run(args.chunksize, args.workers, args.concurrency)
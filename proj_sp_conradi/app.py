@@ -1,6 +1,8 @@
 # -----------------------------------------------------------
 # This module works as a interactive UI for fetching and
-# storing data sets.
+# storing data sets. Cities can also be processed in batch
+# from a config file, see load_config. The layers are run
+# as tasks by the scheduler.
 #
 #
 # Johannes Conradi, 2020 ETH Zuerich
@@ -8,25 +10,151 @@
 # -----------------------------------------------------------
 
 import os
-from proj_sp_conradi import osm_layer
-from proj_sp_conradi import gtfs_layer
-from proj_sp_conradi import region_info_layer
-from proj_sp_conradi import utils
-from proj_sp_conradi import demand_layer
-import censusdata
 import pprint
 import json
+import yaml
+from proj_sp_conradi import scheduler
+from proj_sp_conradi import utils
+
+# The layers and their dependencies (osmnx, urbanaccess, geopandas, censusdata, ...) take seconds to import. They are
+# imported by the functions that need them, so the first prompt or the config check comes right away and each task
+# only loads the layers it uses.
+
+# List of possible counties
+COUNTRIES = ['Switzerland', 'US']
+# Kantone of the NPVM 2017 traffic zones (N_KT), Enk. are the enclaves of foreign territory
+KANTONE = ['AG', 'AI', 'AR', 'BE', 'BL', 'BS', 'Enk.', 'FR', 'GE', 'GL', 'GR', 'JU', 'LIE', 'LU', 'NE', 'NW', 'OW', 'SG',
+           'SH', 'SO', 'SZ', 'TG', 'TI', 'UR', 'VD', 'VS', 'ZG', 'ZH']
 
+# Settings of the run for one city. The interactive UI asks for them, in batch mode they are read from the config file.
+DEFAULTS = {'country': None,
+            'city': None,
+            # OSM street layer
+            'osm': True,
+            'simplify': False,
+            'tolerance': 0,
+            'plot_osm': False,
+            'csr': False,
+            # GTFS public transport layer
+            'gtfs': False,
+            'gtfs_url': None,
+            'plot_gtfs': False,
+            # Time windows of the transit network, e.g. ['monday 07:00:00-10:00:00', 'saturday hourly'], and the number of
+            # processes building them. Without windows the network is built for monday 07:00:00-10:00:00.
+            'gtfs_windows': [],
+            'gtfs_workers': 1,
+            # Store the nodes with one row per stop and the headways per stop and route in a separate table
+            'gtfs_compact': False,
+            # Store the stop times as timetable, see gtfs_layer.store_timetable
+            'gtfs_timetable': False,
+            # Integrated network of the OSM and GTFS layers with connectors between stops and street nodes
+            'integrate': False,
+            # Additional information layer, state, county and census_vars for the US only
+            'additional_info': False,
+            'state': None,
+            'county': None,
+            'census_vars': [],
+            # Census Data API, by default region_info_layer.ACS_URL, e.g. census_stub for offline runs
+            'census_url': None,
+            # Parking, for Switzerland only
+            'parking': False,
+            # Demand layer, osm_mapping for the US only. kanton (e.g. 'ZH') restricts the demand regions of Swiss cities to
+            # the traffic zones of one kanton, by default the zones of all of Switzerland are used.
+            'demand': False,
+            'osm_mapping': False,
+            'kanton': None,
+            # Output
+            'output_format': 'csv',
+            'sidecars': False}
 
-def run():
+
+def check_settings(settings):
     """
-    This function dictates the control flow of the app. It first gets all the necessary information from the user and
-    then collects the data.
+    This function checks the settings of a city and raises a ValueError if they are incomplete or inconsistent.
     """
-    # Directory of project
-    dirname = os.path.dirname(__file__)
-    # List of possible counties
-    countries = ['Switzerland', 'US']
+    unknown = [key for key in settings if key not in DEFAULTS]
+    if unknown:
+        raise ValueError('Unknown settings: ' + ', '.join(unknown))
+    if not settings['city']:
+        raise ValueError('No city given')
+    if settings['country'] not in COUNTRIES:
+        raise ValueError(settings['city'] + ': country has to be one of ' + ', '.join(COUNTRIES))
+    if settings['output_format'] not in ['csv', 'parquet']:
+        raise ValueError(settings['city'] + ': output_format has to be csv or parquet')
+    if settings['simplify'] and not 1 <= int(settings['tolerance']) <= 50:
+        raise ValueError(settings['city'] + ': tolerance has to be between 1 and 50 meters')
+    if settings['gtfs'] and not settings['gtfs_url']:
+        raise ValueError(settings['city'] + ': gtfs_url is needed for the GTFS layer')
+    if settings['integrate'] and not (settings['osm'] and settings['gtfs']):
+        raise ValueError(settings['city'] + ': the OSM and GTFS layers are needed for the integrated network')
+    if settings['gtfs_windows']:
+        from proj_sp_conradi import gtfs_layer
+        try:
+            gtfs_layer.parse_windows(settings['gtfs_windows'])
+        except ValueError as e:
+            raise ValueError(settings['city'] + ': ' + str(e))
+    if int(settings['gtfs_workers']) < 1:
+        raise ValueError(settings['city'] + ': gtfs_workers has to be at least 1')
+    if settings['additional_info'] and settings['country'] == 'US' and not (settings['state'] and settings['county']):
+        raise ValueError(settings['city'] + ': state and county are needed for the additional information layer')
+    if settings['kanton'] is not None and settings['kanton'] not in KANTONE:
+        raise ValueError(settings['city'] + ': kanton has to be one of ' + ', '.join(KANTONE))
+    needs_osm = settings['additional_info'] or settings['parking'] or (
+            settings['demand'] and (settings['country'] == 'Switzerland' or settings['osm_mapping']))
+    if needs_osm and not settings['osm']:
+        raise ValueError(settings['city'] + ': the OSM layer is needed for region, parking and demand mapping')
+
+
+def load_config(path):
+    """
+    This function reads the settings of all cities from a YAML config file. Settings under defaults apply to every
+    city, settings of a city under cities overwrite them. Keys are the ones of DEFAULTS, e.g.
+
+    defaults:
+      output_format: parquet
+    cities:
+      - city: Zurich
+        country: Switzerland
+        additional_info: true
+        parking: true
+        demand: true
+        kanton: ZH
+      - city: Omaha
+        country: US
+        simplify: true
+        tolerance: 10
+        additional_info: true
+        state: '31'
+        county: '055'
+    """
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    defaults = dict(DEFAULTS)
+    defaults.update(config.get('defaults') or {})
+    cities = []
+    for city_config in config.get('cities') or []:
+        settings = dict(defaults)
+        settings.update(city_config)
+        # State and county numbers have leading zeros, YAML reads unquoted ones as int (055 even as octal 45)
+        for key in ['state', 'county']:
+            if settings[key] is not None and not isinstance(settings[key], str):
+                raise ValueError(str(settings['city']) + ': ' + key + ' has to be quoted in ' + path
+                                 + ", e.g. " + key + ": '" + ('31' if key == 'state' else '055') + "'")
+        if isinstance(settings['census_vars'], str):
+            settings['census_vars'] = [v.strip() for v in settings['census_vars'].split(',') if v.strip()]
+        if isinstance(settings['gtfs_windows'], str):
+            settings['gtfs_windows'] = [w.strip() for w in settings['gtfs_windows'].split(',') if w.strip()]
+        check_settings(settings)
+        cities.append(settings)
+    return cities
+
+
+def ask_settings(dirname):
+    """
+    This function gets all the necessary information for one city from the user and returns it as settings, see
+    DEFAULTS.
+    """
+    settings = dict(DEFAULTS)
     # List of cities with demand
     demand_file = dirname+'/cities_with_demand.json'
     with open(demand_file) as json_file:
@@ -41,7 +169,7 @@ def run():
           ' OSM street layer, GTFS public transport, additional information for specific region and demand layer. '
           'Please start with choosing a country: (Switzerland, US)')
     country = input()
-    while not utils.valid_city_input(country, countries):
+    while not utils.valid_city_input(country, COUNTRIES):
         print('Country not list, please choose a different city:')
         country = input()
     print('Please choose a city in ' + country)
@@ -53,6 +181,8 @@ def run():
         city = input()
         print('Do you want to continue with ' + city + '? (y/n)')
         cont = input()
+    settings['country'] = country
+    settings['city'] = city
 
     # OSM layer user interaction
     print('-------------------------------- \n'
@@ -61,6 +191,7 @@ def run():
     while not utils.valid_yn_input(osm):
         print('Wrong input, try again:')
         osm = input()
+    settings['osm'] = osm == 'y'
     if osm == 'y':
         print('Do you want to simplify the OSM graph? If the graph is simplified there will be no OSM IDs per node anymore'
               '(y/n)')
@@ -69,13 +200,11 @@ def run():
             print('Wrong input, try again:')
             simplify = input()
         if simplify == 'y':
-            simplify = True
+            settings['simplify'] = True
             print('The graph will be simplified, please give a range in meters to merge nodes (1<tolerance<50):')
-            tolerance = int(input())
+            settings['tolerance'] = int(input())
         else:
-            simplify = False
             print('The graph will not be simplified')
-            tolerance = 0
         print('Do you want to plot the OSM graph? (y/n)')
         plot_osm = input()
         while not utils.valid_yn_input(plot_osm):
@@ -83,9 +212,13 @@ def run():
             plot_osm = input()
         if plot_osm == 'y':
             print('The plot of the OSM graph will be stored in the output directory.')
-            plot_osm = True
-        else:
-            plot_osm = False
+            settings['plot_osm'] = True
+        print('Do you want to export the OSM graph as compressed sparse row adjacency for simulators? (y/n)')
+        csr = input()
+        while not utils.valid_yn_input(csr):
+            print('Wrong input, try again:')
+            csr = input()
+        settings['csr'] = csr == 'y'
 
     # GTFS layer user interaction
     print('-------------------------------- \n'
@@ -94,18 +227,44 @@ def run():
     while not utils.valid_yn_input(pt):
         print('Wrong input, try again:')
         pt = input()
+    settings['gtfs'] = pt == 'y'
     if pt == 'y':
-        url = gtfs_layer.get_gtfs_url(city)
+        from proj_sp_conradi import gtfs_layer
+        settings['gtfs_url'] = gtfs_layer.get_gtfs_url(city)
         print('Do you plot public transport layer? (y/n)')
         plot_gtfs = input()
-        while not utils.valid_yn_input(pt):
+        while not utils.valid_yn_input(plot_gtfs):
             print('Wrong input, try again:')
             plot_gtfs = input()
         if plot_gtfs == 'y':
             print('The plot of the GTFS graph will be stored in the output directory.')
-            plot_gtfs = True
-        else:
-            plot_gtfs = False
+            settings['plot_gtfs'] = True
+        print('Type the time windows of the network, comma-separated (e.g. monday 07:00:00-10:00:00, saturday hourly)'
+              ' or press enter for monday 07:00:00-10:00:00:')
+        windows = input()
+        while windows.strip() and not utils.valid_windows_input(windows):
+            print('Wrong input, try again:')
+            windows = input()
+        settings['gtfs_windows'] = [w.strip() for w in windows.split(',') if w.strip()]
+        print('Do you want to store one row per stop, with the headways per stop and route in a separate table? (y/n)')
+        compact = input()
+        while not utils.valid_yn_input(compact):
+            print('Wrong input, try again:')
+            compact = input()
+        settings['gtfs_compact'] = compact == 'y'
+        print('Do you want to store the stop times as timetable for lookups of departures? (y/n)')
+        timetable = input()
+        while not utils.valid_yn_input(timetable):
+            print('Wrong input, try again:')
+            timetable = input()
+        settings['gtfs_timetable'] = timetable == 'y'
+        if settings['osm']:
+            print('Do you want to connect the stops to the street layer and store the integrated network? (y/n)')
+            integrate = input()
+            while not utils.valid_yn_input(integrate):
+                print('Wrong input, try again:')
+                integrate = input()
+            settings['integrate'] = integrate == 'y'
     else:
         print('Will not get GTFS layer.')
 
@@ -119,9 +278,10 @@ def run():
               '*****Addtional Information Layer*****\nDo you want to get additional information on region layer? The default '
           'informations for Switzerland are income, population and housing prices (y/n)')
     ad = input()
-    while not utils.valid_yn_input(pt):
+    while not utils.valid_yn_input(ad):
         print('Wrong input, try again:')
         ad = input()
+    settings['additional_info'] = ad == 'y'
     if ad == 'y':
         if not city == 'Zurich' and not country == 'US':
             print("If you want to get additional informations for "+city+" please add the information to the folder "
@@ -132,6 +292,7 @@ def run():
                   '031)? (y/n)')
             state_county = input()
             if state_county == 'n':
+                import censusdata
                 print('List of states:')
                 pprint.pprint(censusdata.geographies(censusdata.censusgeo([('state', '*')]), 'acs5', 2015))
                 print('Please provide the state nr. of ' + city + ' (Example Chicago, Illinois: 17)')
@@ -155,6 +316,8 @@ def run():
                 while not utils.valid_yn_input(cont1):
                     print('Wrong input, try again:')
                     cont1 = input()
+            settings['state'] = state
+            settings['county'] = county
             print('Do you want to add further information other then the default ones? (y/n)')
             fad = input()
             while not utils.valid_yn_input(fad):
@@ -172,8 +335,7 @@ def run():
                     var = input()
                     print('Do you want to continue with: '+ var +'? (y/n)')
                     cont2 = input()
-            else:
-                var = []
+                settings['census_vars'] = var.split(',')
     # Parking user interaction
     if country == 'Switzerland':
 
@@ -186,8 +348,7 @@ def run():
             print("If you want to get parking for "+city+" please add the information to the folder "
                                                          "/resources/additional_info in the same format as shown on the "
                                                          "example of Zurich")
-    else:
-        parking = 'n'
+        settings['parking'] = parking == 'y'
 
     # Demand layer user interaction
     print('-------------------------------- \n'
@@ -196,6 +357,7 @@ def run():
     while not utils.valid_yn_input(demand):
         print('Wrong input, try again:')
         demand = input()
+    settings['demand'] = demand == 'y'
     if demand == 'y':
         if not utils.valid_city_input(city,cities_with_demand):
             print('Unfortunately, we do not have any demand information on '+ city +'. Do you have demand informations and '
@@ -207,6 +369,7 @@ def run():
             while not utils.valid_yn_input(demand_add):
                 print('Wrong input, try again:')
                 demand_add = input()
+            settings['demand'] = demand_add == 'y'
             if demand_add == 'y':
                 print('If you have demand informations please copy and past link in the following:')
                 link = input()
@@ -231,6 +394,7 @@ def run():
                     while not utils.valid_yn_input(osm_mapping):
                         print('Wrong input, try again:')
                         osm_mapping = input()
+                    settings['osm_mapping'] = osm_mapping == 'y'
         else:
             print('We have found following links for the demand layer:')
             print(demand_file_dict[city])
@@ -249,6 +413,7 @@ def run():
                 while not utils.valid_yn_input(osm_mapping):
                     print('Wrong input, try again:')
                     osm_mapping = input()
+                settings['osm_mapping'] = osm_mapping == 'y'
 
             if country == 'Switzerland':
                 print(
@@ -260,79 +425,291 @@ def run():
                 while not utils.valid_yn_input(cont3):
                     print('Will not continue until you confirm with y:')
                     cont3 = input()
+                print('Do you want to map the nodes to the regions of one kanton only? Type its abbreviation (e.g. ZH) '
+                      'or press enter for all of Switzerland:')
+                kanton = input().strip()
+                while kanton and kanton not in KANTONE:
+                    print('Wrong input, type one of ' + ', '.join(KANTONE) + ' or press enter:')
+                    kanton = input().strip()
+                settings['kanton'] = kanton or None
 
+    # Output format user interaction
+    print('-------------------------------- \n'
+          '*****Output*****\nIn which format do you want to store the data sets? GeoParquet files are smaller, keep '
+          'the data types and can be read column by column. (csv/parquet)')
+    output_format = input()
+    while output_format not in ['csv', 'parquet']:
+        print('Wrong input, try again:')
+        output_format = input()
+    settings['output_format'] = output_format
+    print('Do you want to store the columns added by the region, parking and demand layers in separate files next to '
+          'the street layer, so the geometry is not stored again? (y/n)')
+    sidecars = input()
+    while not utils.valid_yn_input(sidecars):
+        print('Wrong input, try again:')
+        sidecars = input()
+    settings['sidecars'] = sidecars == 'y'
 
+    ### End of user interaction ###
 
-    print('-------------------------------- \nEnd of user interaction. Will start processing data now. Sit back and '
-          'relax ;)')
+    return settings
 
-    ### End of user interaction ###
 
-    # Directories
-    osm_eges_filename = 'osm_edges_' + city + '.csv'
-    osm_nodes_filename = 'osm_nodes_' + city + '.csv'
-    geom_filename = 'geom_' + city + '.csv'
-    gtfs_eges_filename = 'gtfs_edges_' + city + '.csv'
-    gtfs_nodes_filename = 'gtfs_nodes_' + city + '.csv'
-    gtfs_stop_times_filename = 'gtfs_stop_times_' + city + '.csv'
-    demand_filename = 'demand_w_osmid' + city + '.csv'
+def output_paths(dirname, settings):
+    """
+    This function returns the paths of all output files of a city.
+    """
+    city = settings['city']
+    ext = '.' + settings['output_format']
     output_path = os.path.join(dirname, 'output')
-    osm_edges_path = os.path.join(output_path, osm_eges_filename)
-    osm_nodes_path = os.path.join(output_path, osm_nodes_filename)
-    gtfs_edges_path = os.path.join(output_path, gtfs_eges_filename)
-    gtfs_nodes_path = os.path.join(output_path, gtfs_nodes_filename)
-    stop_times_path = os.path.join(output_path, gtfs_stop_times_filename)
-    geom_filename_path = os.path.join(output_path, geom_filename)
-    demand_path = os.path.join(output_path, demand_filename)
-    path_fig_osm = dirname + '/output/osm_plot_' + city + '.png'
-    path_fig_gtfs = dirname + '/output/gtfs_plot_' + city + '.png'
-
-
-    # Get, plot and store osm layer
-    if osm == 'y':
-        osm_nodes, osm_edges = osm_layer.get_osm(dirname, city, simplify, tolerance, plot_osm, path_fig_osm)
-        osm_nodes.reset_index(drop=True)
-        osm_edges.to_csv(osm_edges_path)
-        osm_nodes.to_csv(osm_nodes_path)
+    return {'osm_edges': os.path.join(output_path, 'osm_edges_' + city + ext),
+            'osm_nodes': os.path.join(output_path, 'osm_nodes_' + city + ext),
+            'osm_csr': os.path.join(output_path, 'osm_csr_' + city),
+            'gtfs_edges': os.path.join(output_path, 'gtfs_edges_' + city + ext),
+            'gtfs_nodes': os.path.join(output_path, 'gtfs_nodes_' + city + ext),
+            'gtfs_timetable': os.path.join(output_path, 'gtfs_timetable_' + city),
+            'integrated_nodes': os.path.join(output_path, 'integrated_nodes_' + city + ext),
+            'integrated_edges': os.path.join(output_path, 'integrated_edges_' + city + ext),
+            'gtfs_headways': os.path.join(output_path, 'gtfs_headways_' + city + ext),
+            'gtfs_routes': os.path.join(output_path, 'gtfs_routes_' + city + ext),
+            'geom': os.path.join(output_path, 'geom_' + city + ext),
+            'demand': os.path.join(output_path, 'demand_w_osmid' + city + ext),
+            'fig_osm': dirname + '/output/osm_plot_' + city + '.png',
+            'fig_gtfs': dirname + '/output/gtfs_plot_' + city + '.png'}
 
-    # Get, plot and store plot GTFS layer
-    if pt == 'y':
-        gtfs_layer.download_store_gtfs(url, city, dirname, gtfs_edges_path, gtfs_nodes_path, stop_times_path, plot_gtfs,
-                                       path_fig_gtfs)
 
-    # Get and store additional information on region layer
-    if ad == 'y' and not country == 'US':
-        # Gets "Statistische Quartiere" for Zurich and adds further info to each region
-        geomdf = region_info_layer.get_geom(dirname, city)
-        geomdf.to_csv(geom_filename_path)
-        # Map each node to a geograpic region
-        osm_nodes = region_info_layer.get_geo_node(osm_nodes, geomdf, simplify)
-        osm_nodes.to_csv(osm_nodes_path)
+def new_columns(frame, columns):
+    """Helper function, to get only the columns a layer added to a data set"""
+    import pandas as pd
+
+    return pd.DataFrame(frame[[c for c in frame.columns if c not in columns]])
+
+
+def osm_task(dirname, settings, paths):
+    """
+    This function gets the osm layer and adds speed and travel time to the edges. It is stored by store_task once all
+    layers have added their columns.
+    """
+    import geopandas as gpd
+    from proj_sp_conradi import osm_layer
+    from proj_sp_conradi import region_info_layer
+
+    osm_nodes, osm_edges = osm_layer.get_osm(dirname, settings['city'], settings['simplify'], settings['tolerance'])
+    if isinstance(osm_nodes, gpd.GeoSeries):
+        osm_nodes = gpd.GeoDataFrame(geometry=osm_nodes)
+    # Add speed-limit to each edge and
+    # calculate time it takes to travel on road-segment.
+    osm_edges = region_info_layer.get_speed_time(osm_edges)
+    if settings['csr']:
+        osm_layer.export_csr(osm_nodes, osm_edges, paths['osm_csr'])
+    return osm_nodes, osm_edges
+
+
+def gtfs_task(dirname, settings, paths):
+    """This function gets and stores the GTFS layer."""
+    from proj_sp_conradi import gtfs_layer
+
+    timetable = paths['gtfs_timetable'] if settings['gtfs_timetable'] else None
+    compact = [paths['gtfs_headways'], paths['gtfs_routes']] if settings['gtfs_compact'] else []
+    gtfs_layer.download_store_gtfs(settings['gtfs_url'], settings['city'], dirname, paths['gtfs_edges'],
+                                   paths['gtfs_nodes'], timetable, settings['gtfs_windows'],
+                                   int(settings['gtfs_workers']), *compact)
+
 
-    if ad == 'y' and country == 'US':
+def geom_task(dirname, settings, paths):
+    """This function gets and stores the regions with additional information."""
+    from proj_sp_conradi import storage
+    from proj_sp_conradi import region_info_layer
+
+    if settings['country'] == 'US':
         # Gets "census tracts" for city object in US and adds further info to each region
-        geomdf = region_info_layer.get_geom_us(dirname, city, county, state, var)
-        geomdf.to_csv(geom_filename_path)
-        # Map each node to a geograpic region
-        osm_nodes = region_info_layer.get_geo_node_us(dirname, osm_nodes, state, county, simplify)
-        osm_nodes.to_csv(osm_nodes_path)
-        # Add speed-limit to each edge and
-        # calculate time it takes to travel on road-segment.
-        #osm_edges = region_info_layer.get_speed_time(osm_edges)
-
-    if parking == 'y':
-        # Add number of parking spots available at each edge
-        osm_edges = region_info_layer.get_parking(osm_edges, dirname, city)
-        osm_edges.to_csv(osm_edges_path)
-
-    # Get and store demand layer
-    if demand == 'y' and not country == 'Switzerland':
-        demand_df = demand_layer.get_demand_trip(dirname, city, osm_nodes, osm_mapping)
-        demand_df.to_csv(demand_path)
-    if demand == 'y' and country == 'Switzerland':
-        osm_nodes = demand_layer.map_osm_demandgeo(dirname, osm_nodes) # Only for Kanton ZH
-        osm_nodes.to_csv(osm_nodes_path)
-    print('Done processing data.')
+        geomdf = region_info_layer.get_geom_us(dirname, settings['city'], settings['county'], settings['state'],
+                                               settings['census_vars'], settings['census_url'])
+    else:
+        # Gets "Statistische Quartiere" for Zurich and adds further info to each region
+        geomdf = region_info_layer.get_geom(dirname, settings['city'])
+    storage.write_layer(geomdf, paths['geom'])
+    return geomdf
+
+
+def region_task(dirname, settings, osm, geomdf):
+    """This function maps each node to a geograpic region and returns the new columns."""
+    from proj_sp_conradi import region_info_layer
+
+    osm_nodes = osm[0].copy()
+    columns = list(osm_nodes.columns)
+    if settings['country'] == 'US':
+        osm_nodes = region_info_layer.get_geo_node_us(dirname, osm_nodes, settings['state'], settings['county'])
+    else:
+        osm_nodes = region_info_layer.get_geo_node(osm_nodes, geomdf)
+    return new_columns(osm_nodes, columns)
+
+
+def integrate_task(paths, osm, *deps):
+    """This function connects the stored GTFS layer to the osm layer and stores the integrated network."""
+    from proj_sp_conradi import integration_layer
+
+    integration_layer.store_integrated(osm[1], paths['gtfs_nodes'], paths['gtfs_edges'], paths['integrated_nodes'],
+                                       paths['integrated_edges'])
+
+
+def parking_task(dirname, settings, osm):
+    """This function adds the number of parking spots available at each edge and returns the new columns."""
+    from proj_sp_conradi import region_info_layer
+
+    osm_edges = osm[1].copy()
+    columns = list(osm_edges.columns)
+    osm_edges = region_info_layer.get_parking(osm_edges, dirname, settings['city'])
+    return new_columns(osm_edges, columns)
+
+
+def demand_task(dirname, settings, paths, chunksize, workers, osm=None):
+    """
+    This function gets and stores the demand layer. For Swiss cities the nodes are mapped to the demand regions and
+    the new columns are returned.
+    """
+    from proj_sp_conradi import demand_layer
+
+    if settings['country'] == 'Switzerland':
+        # Regions of all Swiss traffic zones, or of the zones of one kanton
+        osm_nodes = osm[0].copy()
+        columns = list(osm_nodes.columns)
+        return new_columns(demand_layer.map_osm_demandgeo(dirname, osm_nodes, settings['kanton']), columns)
+    demand_layer.stream_demand_trip(dirname, settings['city'], osm[0] if osm is not None else None,
+                                    settings['osm_mapping'], paths['demand'], chunksize, workers)
+
+
+def plot_osm_task(paths, *deps):
+    """This function plots the stored osm layer."""
+    from proj_sp_conradi import plotting
+
+    plotting.plot_osm(paths['osm_edges'], paths['fig_osm'], paths['osm_nodes'])
+
+
+def plot_gtfs_task(settings, paths, *deps):
+    """This function plots the stored GTFS layer, the first time window if there are several."""
+    from proj_sp_conradi import plotting
+
+    nodes_path, edges_path = paths['gtfs_nodes'], paths['gtfs_edges']
+    if settings['gtfs_windows']:
+        from proj_sp_conradi import gtfs_layer
+        day, timerange = gtfs_layer.parse_windows(settings['gtfs_windows'])[0]
+        nodes_path = gtfs_layer.window_path(nodes_path, day, timerange)
+        edges_path = gtfs_layer.window_path(edges_path, day, timerange)
+    plotting.plot_gtfs(nodes_path, edges_path, paths['fig_gtfs'])
 
 
+def store_task(settings, paths, layers, osm, *columns):
+    """
+    This function stores the osm layer with the columns added by layers, given as (name, nodes or edges) in the same
+    order as columns. Layers that failed have None as columns, the osm layer is stored without them.
+    """
+    from proj_sp_conradi import storage
+
+    nodes_output = storage.LayerOutput(osm[0], paths['osm_nodes'])
+    edges_output = storage.LayerOutput(osm[1], paths['osm_edges'])
+    for (layer, target), frame in zip(layers, columns):
+        if frame is None:
+            print('The ' + layer + ' layer failed, its columns are not stored.')
+            continue
+        output = nodes_output if target == 'nodes' else edges_output
+        output.add(layer, frame)
+    nodes_output.flush(settings['sidecars'])
+    edges_output.flush(settings['sidecars'])
+
+
+def city_tasks(dirname, settings, chunksize=100000, workers=1):
+    """
+    This function returns the tasks that collect and store the data sets of one city as given by settings, see
+    DEFAULTS. The OSM layer is needed by the region, parking and demand mapping, the GTFS layer and the download of the
+    regions are independent. Task names start with the city, e.g. Zurich/osm.
+    """
+    paths = output_paths(dirname, settings)
+    prefix = settings['city'] + '/'
+    tasks = []
+    layers = []
+    if settings['osm']:
+        tasks.append(scheduler.Task(prefix + 'osm', osm_task, (dirname, settings, paths), kind='process'))
+    if settings['gtfs']:
+        # urbanaccess keeps feeds and networks in module globals, each city gets a fresh process
+        tasks.append(scheduler.Task(prefix + 'gtfs', gtfs_task, (dirname, settings, paths), kind='isolated'))
+    if settings['additional_info']:
+        tasks.append(scheduler.Task(prefix + 'geom', geom_task, (dirname, settings, paths), kind='thread'))
+        tasks.append(scheduler.Task(prefix + 'region', region_task, (dirname, settings),
+                                    [prefix + 'osm', prefix + 'geom'], kind='process'))
+        layers.append(('region', 'nodes'))
+    if settings['parking']:
+        tasks.append(scheduler.Task(prefix + 'parking', parking_task, (dirname, settings), [prefix + 'osm'],
+                                    kind='process'))
+        layers.append(('parking', 'edges'))
+    if settings['demand'] and settings['country'] == 'Switzerland':
+        tasks.append(scheduler.Task(prefix + 'demand', demand_task, (dirname, settings, paths, chunksize, workers),
+                                    [prefix + 'osm'], kind='process'))
+        layers.append(('demand', 'nodes'))
+    elif settings['demand']:
+        # Streams the demand file with its own pool of workers
+        tasks.append(scheduler.Task(prefix + 'demand', demand_task, (dirname, settings, paths, chunksize, workers),
+                                    [prefix + 'osm'] if settings['osm'] else [], kind='thread'))
+    if settings['osm']:
+        # The osm layer is stored even if some of the layers adding columns to it fail
+        tasks.append(scheduler.Task(prefix + 'store', store_task, (settings, paths, layers),
+                                    [prefix + 'osm'] + [prefix + layer for layer, _ in layers], kind='thread',
+                                    optional=[prefix + layer for layer, _ in layers]))
+    if settings['integrate']:
+        tasks.append(scheduler.Task(prefix + 'integrate', integrate_task, (paths,), [prefix + 'osm', prefix + 'gtfs'],
+                                    kind='process'))
+    # Plots are drawn from the stored outputs in the background
+    if settings['osm'] and settings['plot_osm']:
+        tasks.append(scheduler.Task(prefix + 'plot_osm', plot_osm_task, (paths,), [prefix + 'store'],
+                                    kind='background'))
+    if settings['gtfs'] and settings['plot_gtfs']:
+        tasks.append(scheduler.Task(prefix + 'plot_gtfs', plot_gtfs_task, (settings, paths), [prefix + 'gtfs'],
+                                    kind='background'))
+    return tasks
+
+
+def failed_cities(cities, errors):
+    """Helper function, to get the cities with failed tasks"""
+    return [settings['city'] for settings in cities if any(name.startswith(settings['city'] + '/') for name in errors)]
+
+
+def run(chunksize=100000, workers=1, concurrency=1):
+    """
+    This function dictates the control flow of the app. It first gets all the necessary information from the user and
+    then collects the data. The demand file is processed in chunks of chunksize trips by workers processes, up to
+    concurrency layers are processed at the same time.
+    """
+    # Directory of project
+    dirname = os.path.dirname(__file__)
+    settings = ask_settings(dirname)
+    check_settings(settings)
+    print('-------------------------------- \nEnd of user interaction. Will start processing data now. Sit back and '
+          'relax ;)')
+    _, errors = scheduler.run_tasks(city_tasks(dirname, settings, chunksize, workers), concurrency)
+    if errors:
+        print('Done processing data, with errors in: ' + ', '.join(errors))
+    else:
+        print('Done processing data.')
+
 
+def run_batch(config_path, chunksize=100000, workers=1, concurrency=1, processes=None):
+    """
+    This function processes all cities of a config file (see load_config) without user interaction. The layers of all
+    cities are run together by the scheduler, at most concurrency at the same time and CPU bound ones in a pool of
+    processes processes. A city that fails does not stop the others. Returns the names of the failed cities.
+    """
+    # Directory of project
+    dirname = os.path.dirname(__file__)
+    cities = load_config(config_path)
+    names = [settings['city'] for settings in cities]
+    if len(set(names)) < len(names):
+        raise ValueError('Cities have to be unique in ' + config_path)
+    tasks = []
+    for settings in cities:
+        tasks += city_tasks(dirname, settings, chunksize, workers)
+    _, errors = scheduler.run_tasks(tasks, concurrency, processes)
+    failed = failed_cities(cities, errors)
+    print('Done processing data of ' + str(len(cities) - len(failed)) + ' of ' + str(len(cities)) + ' cities.')
+    if failed:
+        print('Failed: ' + ', '.join(failed))
+    return failed
@@ -0,0 +1,339 @@
+# -----------------------------------------------------------
+# This module provides benchmarks for the heavy processing
+# steps of the layers. Run with:
+# python -m proj_sp_conradi.benchmark [name ...]
+#
+#
+# Johannes Conradi, 2020 ETH Zuerich
+# email: conradij@ethz.ch
+# -----------------------------------------------------------
+
+import os
+import io
+import sys
+import time
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import wkt
+from shapely.geometry import Point
+from shapely.geometry.polygon import Polygon
+import shapefile
+from proj_sp_conradi import spatial_index
+from proj_sp_conradi import demand_layer
+from proj_sp_conradi import region_info_layer
+from proj_sp_conradi import scheduler
+from proj_sp_conradi import gtfs_layer
+
+# Heavy dependencies that must not be imported before the first prompt, and the time budget for the import of app
+HEAVY_MODULES = ['osmnx', 'urbanaccess', 'pandana', 'geopandas', 'pandas', 'matplotlib', 'censusdata', 'shapefile',
+                 'pyproj', 'scipy']
+IMPORT_BUDGET = 0.3
+
+# Bounding box (lon_min, lat_min, lon_max, lat_max) and number of nodes of Omaha. The stored Omaha node output has no
+# coordinates, so an Omaha sized node set is drawn at random inside the city.
+OMAHA_BBOX = (-96.20, 41.19, -95.87, 41.37)
+OMAHA_NODES = 16075
+
+
+def load_nodes(path):
+    """
+    This function reads a stored osm_nodes csv into a GeoDataFrame indexed by osmid.
+    """
+    nodes = pd.read_csv(path, index_col=0)
+    nodes['geometry'] = nodes['geometry'].apply(wkt.loads)
+    return gpd.GeoDataFrame(nodes, geometry='geometry')
+
+
+def random_nodes(n, bbox, seed=0):
+    """
+    This function draws n random nodes inside a bounding box.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(bbox[0], bbox[2], n)
+    y = rng.uniform(bbox[1], bbox[3], n)
+    return gpd.GeoDataFrame({'osmid': np.arange(n)}, geometry=[Point(xy) for xy in zip(x, y)])
+
+
+def random_trips(n, bounds, seed=1):
+    """
+    This function draws n random coordinates inside the bounds of a node set.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(bounds[0], bounds[2], n)
+    y = rng.uniform(bounds[1], bounds[3], n)
+    return x, y
+
+
+def brute_force_snap(points, x, y):
+    """
+    This is the old per trip search of demand_layer.get_demand_trip, kept as reference.
+    """
+    return np.array([points['geometry'].distance(Point(x[i], y[i])).idxmin() for i in range(len(x))])
+
+
+def bench_snapping(dirname, n_trips=1000000, n_check=200):
+    """
+    This function compares the KD-tree snapping with the brute force search on the Zurich and Omaha node sets.
+    """
+    node_sets = {'Zurich': load_nodes(os.path.join(dirname, 'output', 'osm_nodes_Zurich.csv')),
+                 'Omaha': random_nodes(OMAHA_NODES, OMAHA_BBOX)}
+    for city, points in node_sets.items():
+        x, y = random_trips(n_trips, points.total_bounds)
+        start = time.perf_counter()
+        index = spatial_index.NodeIndex(points)
+        t_build = time.perf_counter() - start
+        start = time.perf_counter()
+        ids, dist = index.snap(x, y)
+        t_snap = time.perf_counter() - start
+        start = time.perf_counter()
+        reference = brute_force_snap(points, x[:n_check], y[:n_check])
+        t_brute = (time.perf_counter() - start) / n_check * n_trips
+        mismatches = int(np.sum(ids[:n_check] != reference))
+        print(city + ': ' + str(len(points)) + ' nodes, ' + str(n_trips) + ' trips')
+        print('  index build     %8.3f s' % t_build)
+        print('  kd-tree snap    %8.3f s (%.0f trips/s)' % (t_snap, n_trips / t_snap))
+        print('  brute force     %8.0f s (extrapolated from %d trips)' % (t_brute, n_check))
+        print('  mismatches      %8d of %d checked' % (mismatches, n_check))
+
+
+def bench_demand_workers(dirname, n_trips=2000000, chunksize=100000):
+    """
+    This function measures how streaming the demand layer scales with the number of worker processes. A synthetic
+    demand file with n_trips trips inside Omaha is written to a temporary directory.
+    """
+    points = random_nodes(OMAHA_NODES, OMAHA_BBOX)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'resources', 'demand_layer'))
+        x, y = random_trips(2 * n_trips, points.total_bounds)
+        trips = pd.DataFrame({'Trip ID': np.arange(n_trips),
+                              'Pickup Centroid Latitude': y[:n_trips],
+                              'Pickup Centroid Longitude': x[:n_trips],
+                              'Dropoff Centroid Latitude': y[n_trips:],
+                              'Dropoff Centroid Longitude': x[n_trips:]})
+        trips.to_csv(os.path.join(tmp, 'resources', 'demand_layer', 'demand_Bench.csv'), index=False)
+        output_path = os.path.join(tmp, 'demand_w_osmidBench.csv')
+        timings = {}
+        workers = 1
+        while workers <= os.cpu_count():
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                demand_layer.stream_demand_trip(tmp, 'Bench', points, True, output_path, chunksize, workers)
+            timings[workers] = time.perf_counter() - start
+            print('  workers %3d %8.3f s (%.0f trips/s, speedup %.2f)'
+                  % (workers, timings[workers], n_trips / timings[workers], timings[1] / timings[workers]))
+            workers *= 2
+
+
+def loop_regions(geometry, polygons, labels):
+    """
+    This is the old nested loop of region_info_layer.get_geo_node, kept as reference.
+    """
+    region = np.zeros(len(geometry))
+    for i, point in enumerate(geometry):
+        for j, poly in enumerate(polygons):
+            if poly.contains(point):
+                region[i] = labels[j]
+    return region
+
+
+def bench_regions(dirname):
+    """
+    This function compares the indexed region assignment with the nested loop for the Zurich quarters and the Omaha
+    (Douglas County) census tracts.
+    """
+    info_path = os.path.join(dirname, 'resources', 'additional_info')
+    geomdf = gpd.read_file(os.path.join(info_path, 'geo_Zurich.json')).set_index('qnr')
+    sf = shapefile.Reader(os.path.join(info_path, 'state_31', 'cb_2015_31_tract_500k'))
+    tracts = [(Polygon(shape.points), rec[2]) for shape, rec in zip(sf.shapes(), sf.records())
+              if rec[0] == '31' and rec[1] == '055']
+    cases = {'Zurich': (load_nodes(os.path.join(dirname, 'output', 'osm_nodes_Zurich.csv'))['geometry'],
+                        list(geomdf['geometry']), list(geomdf.index)),
+             'Omaha': (random_nodes(OMAHA_NODES, OMAHA_BBOX)['geometry'],
+                       [t[0] for t in tracts], [t[1] for t in tracts])}
+    for city, (geometry, polygons, labels) in cases.items():
+        start = time.perf_counter()
+        region = spatial_index.assign_regions(geometry, polygons, labels)
+        t_index = time.perf_counter() - start
+        start = time.perf_counter()
+        reference = loop_regions(geometry, polygons, labels)
+        t_loop = time.perf_counter() - start
+        print(city + ': ' + str(len(geometry)) + ' nodes, ' + str(len(polygons)) + ' regions')
+        print('  indexed join    %8.3f s' % t_index)
+        print('  nested loop     %8.3f s' % t_loop)
+        print('  mismatches      %8d' % int(np.sum(region != reference)))
+
+
+def load_edges(path):
+    """
+    This function reads a stored osm_edges csv into a GeoDataFrame.
+    """
+    edges = pd.read_csv(path, index_col=0)
+    edges['geometry'] = edges['geometry'].apply(wkt.loads)
+    return gpd.GeoDataFrame(edges, geometry='geometry')
+
+
+def bench_parking(dirname, n_spots=20000, n_check=200):
+    """
+    This function compares the indexed nearest edge search of region_info_layer.build_parking with the search over all
+    edges, for random parking spots on the Zurich edges.
+    """
+    edges = load_edges(os.path.join(dirname, 'output', 'osm_edges_Zurich.csv'))
+    x, y = random_trips(n_spots, edges.total_bounds)
+    spots = gpd.GeoSeries([Point(xy) for xy in zip(x, y)])
+    start = time.perf_counter()
+    nearest, _ = spatial_index.nearest_geometries(edges['geometry'], spots, 0.0002)
+    t_index = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = np.array([edges['geometry'].reset_index(drop=True).distance(spots[i]).idxmin()
+                          for i in range(n_check)])
+    t_loop = (time.perf_counter() - start) / n_check * n_spots
+    print('Zurich: ' + str(len(edges)) + ' edges, ' + str(n_spots) + ' parking spots')
+    print('  indexed search  %8.3f s' % t_index)
+    print('  all edges       %8.3f s (extrapolated from %d spots)' % (t_loop, n_check))
+    print('  mismatches      %8d of %d checked' % (int(np.sum(nearest[:n_check] != reference)), n_check))
+
+
+def bench_speed(dirname, n_edges=100000):
+    """
+    This function measures region_info_layer.get_speed_time on the Zurich edges, repeated to n_edges edges.
+    """
+    edges = pd.read_csv(os.path.join(dirname, 'output', 'osm_edges_Zurich.csv'), index_col=0)
+    edges = pd.concat([edges] * (n_edges // len(edges) + 1), ignore_index=True).iloc[:n_edges]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        edges = region_info_layer.get_speed_time(edges)
+    print(str(len(edges)) + ' edges: %.3f s, %d edges without speed' % (time.perf_counter() - start,
+                                                                      int(edges['speed'].isna().sum())))
+
+
+
+def bench_headways(dirname, copies=(1, 50)):
+    """
+    This function compares gtfs_layer.join_headways with gtfs_layer.compact_headways on the stops and headways of the
+    Zurich nodes, repeated copies times with distinct stop and route ids for feeds of the size of Switzerland.
+    """
+    zurich = pd.read_csv(os.path.join(dirname, 'output', 'gtfs_nodes_Zurich.csv'), index_col=0)
+    for n in copies:
+        suffixes = np.repeat(['_' + str(i) for i in range(n)], len(zurich))
+        stop_ids = np.tile(zurich.index.to_numpy(dtype=str), n) + suffixes
+        route_ids = np.tile(zurich['unique_route_id'].to_numpy(dtype=str), n) + suffixes
+        nodes = pd.DataFrame({'x': np.tile(zurich['x'].to_numpy(), n), 'y': np.tile(zurich['y'].to_numpy(), n)},
+                             index=stop_ids)
+        nodes = nodes[~nodes.index.duplicated()]
+        headways = pd.DataFrame({'mean': np.tile(zurich['headways_mean'].to_numpy(), n), 'unique_stop_id': stop_ids,
+                                 'unique_route_id': route_ids})
+        start = time.perf_counter()
+        joined = gtfs_layer.join_headways(nodes, headways)
+        t_join = time.perf_counter() - start
+        start = time.perf_counter()
+        stops, long, routes = gtfs_layer.compact_headways(nodes, headways)
+        t_compact = time.perf_counter() - start
+        size_join = joined.memory_usage(deep=True).sum()
+        size_compact = sum(df.memory_usage(deep=True).sum() for df in [stops, long, routes])
+        print(str(len(headways)) + ' stop-route pairs: join %.3f s %6d rows %7.1f MB, compact %.3f s %6d stops %7.1f MB'
+              % (t_join, len(joined), size_join / 1e6, t_compact, len(stops), size_compact / 1e6))
+
+
+def sleep_task(seconds, *deps):
+    """
+    This is a stand-in for a layer that takes seconds, for bench_scheduler.
+    """
+    time.sleep(seconds)
+    return seconds
+
+
+def bench_scheduler(dirname, n_cities=20, durations=None):
+    """
+    This function runs the task graph of app.city_tasks for n_cities cities with layers replaced by sleep_task, and
+    compares the wall-clock time for different concurrency limits with the sequential time and the critical path
+    (osm, region, store). durations are the seconds of each layer, by default rough shares of a medium city.
+    """
+    durations = durations or {'osm': 2.0, 'gtfs': 1.5, 'geom': 1.0, 'region': 0.5, 'parking': 0.5, 'store': 0.3}
+
+    def tasks():
+        tasks = []
+        for i in range(n_cities):
+            prefix = 'city' + str(i) + '/'
+            tasks += [scheduler.Task(prefix + 'osm', sleep_task, (durations['osm'],), kind='process'),
+                      scheduler.Task(prefix + 'gtfs', sleep_task, (durations['gtfs'],), kind='isolated'),
+                      scheduler.Task(prefix + 'geom', sleep_task, (durations['geom'],), kind='thread'),
+                      scheduler.Task(prefix + 'region', sleep_task, (durations['region'],),
+                                     [prefix + 'osm', prefix + 'geom'], kind='process'),
+                      scheduler.Task(prefix + 'parking', sleep_task, (durations['parking'],), [prefix + 'osm'],
+                                     kind='process'),
+                      scheduler.Task(prefix + 'store', sleep_task, (durations['store'],),
+                                     [prefix + 'osm', prefix + 'region', prefix + 'parking'], kind='thread')]
+        return tasks
+
+    critical = durations['osm'] + max(durations['region'], durations['parking']) + durations['store']
+    print(str(n_cities) + ' cities, sequential %.1f s, critical path %.1f s'
+          % (n_cities * sum(durations.values()), critical))
+    for concurrency in [1, 4, 16, 4 * n_cities]:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.run_tasks(tasks(), concurrency, processes=concurrency)
+        print('  concurrency %3d %8.1f s' % (concurrency, time.perf_counter() - start))
+
+
+def import_times(statement):
+    """
+    This function runs statement in a new interpreter with -X importtime and returns the cumulative import time in
+    seconds of each module.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=root, stderr=subprocess.PIPE,
+                         universal_newlines=True, check=True).stderr
+    times = {}
+    for line in out.splitlines():
+        parts = line.split('|')
+        if line.startswith('import time:') and len(parts) == 3 and parts[1].strip().isdigit():
+            times[parts[2].strip()] = int(parts[1]) / 1e6
+    return times
+
+
+def bench_import_time(dirname, n_top=10):
+    """
+    This function measures the startup of python -m proj_sp_conradi: the import of app, which comes before the first
+    prompt, and the import plus the check of a config file for the batch mode. It lists the slowest imports and the
+    heavy dependencies that were loaded although no layer ran yet.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, 'cities.yaml')
+        with open(config_path, 'w') as f:
+            f.write('cities:\n  - city: Zurich\n    country: Switzerland\n')
+        cases = {'import app': 'import proj_sp_conradi.app',
+                 'config check': 'from proj_sp_conradi import app; app.load_config(' + repr(config_path) + ')'}
+        for name, statement in cases.items():
+            times = import_times(statement)
+            total = times.get('proj_sp_conradi.app', 0)
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', statement], cwd=os.path.dirname(dirname), check=True)
+            wall = time.perf_counter() - start
+            print(name + ': import of app %.3f s, interpreter wall time %.3f s%s'
+                  % (total, wall, ' (over budget of %.1f s)' % IMPORT_BUDGET if total > IMPORT_BUDGET else ''))
+            for module, t in sorted(times.items(), key=lambda item: -item[1])[:n_top]:
+                print('  %-40s %8.3f s' % (module, t))
+            heavy = [module for module in HEAVY_MODULES if module in times]
+            print('  heavy modules loaded: ' + (', '.join(heavy) if heavy else 'none'))
+
+
+BENCHMARKS = {'snapping': bench_snapping,
+              'regions': bench_regions,
+              'parking': bench_parking,
+              'speed': bench_speed,
+              'headways': bench_headways,
+              'demand_workers': bench_demand_workers,
+              'scheduler': bench_scheduler,
+              'import_time': bench_import_time}
+
+
+if __name__ == '__main__':
+    dirname = os.path.dirname(__file__)
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('-------------------------------- \n*****Benchmark ' + name + '*****')
+        BENCHMARKS[name](dirname)
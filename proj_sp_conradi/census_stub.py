@@ -0,0 +1,96 @@
+# -----------------------------------------------------------
+# This module provides a local stand-in for the Census Data
+# API, to run the additional information layer offline. Run
+# with: python -m proj_sp_conradi.census_stub [--port 8000]
+# and set census_url to the printed url.
+#
+#
+# Johannes Conradi, 2020 ETH Zuerich
+# email: conradij@ethz.ch
+# -----------------------------------------------------------
+
+import json
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Number of tracts of every county, and the number of variables per request the API allows
+TRACTS = 5
+MAX_VARIABLES = 50
+
+
+def stub_value(state, county, tract, variable):
+    """Helper function, to get a fixed made-up value of a variable for a tract"""
+    digest = hashlib.sha1(':'.join([state, county, tract, variable]).encode()).hexdigest()
+    return str(int(digest[:8], 16) % 100000)
+
+
+def stub_rows(state, county, variables):
+    """
+    This function returns the response of the API for variables of all tracts of a county: a header row followed by
+    one row per tract with NAME, the variables, state, county and tract.
+    """
+    rows = [variables + ['state', 'county', 'tract']]
+    for i in range(TRACTS):
+        tract = '%06d' % (100 * (i + 1))
+        name = 'Census Tract ' + str(i + 1) + ', Stub County ' + county + ', Stub State ' + state
+        rows.append([name if v == 'NAME' else stub_value(state, county, tract, v) for v in variables]
+                    + [state, county, tract])
+    return rows
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers requests like /2015/acs/acs5?get=NAME,B01001_001E&for=tract:*&in=state:31 county:055 and records the
+    requested variables in server.requested.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        variables = query.get('get', [''])[0].split(',')
+        where = dict(part.split(':', 1) for part in ' '.join(query.get('in', [])).split() if ':' in part)
+        if len(variables) > MAX_VARIABLES:
+            self.answer(400, 'error: cannot request more than ' + str(MAX_VARIABLES) + ' variables')
+        elif query.get('for') != ['tract:*'] or 'state' not in where or 'county' not in where:
+            self.answer(400, 'error: only tract:* in a state and county is supported')
+        else:
+            self.server.requested.append(variables)
+            self.answer(200, json.dumps(stub_rows(where['state'], where['county'], variables)))
+
+    def answer(self, status, body):
+        """Helper function, to send a response"""
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0):
+    """
+    This function starts the stub server on localhost in a background thread. Returns the server and its url, stop it
+    with server.shutdown().
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.requested = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:' + str(server.server_address[1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Census Data API')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    server, url = serve(args.port)
+    print('Census Data API stub running at ' + url + ', stop with Ctrl+C')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -7,11 +7,32 @@
 # -----------------------------------------------------------
 
 import pandas as pd
-from shapely.geometry import Point
 import zipfile
 import geopandas as gpd
-from pyproj import Transformer
-import numpy as np
+import io
+import os
+import time
+import tempfile
+import threading
+import multiprocessing
+from collections import deque
+from proj_sp_conradi import spatial_index
+from proj_sp_conradi import storage
+
+
+def snap_trips(trips, index):
+    """This function maps the OD coordinates of a DataFrame of trips to osm ids with a prebuilt spatial_index.NodeIndex.
+    The osm ids and snap distances are added as columns."""
+
+    # Find the closest OSM-node to origin and destination of all trips at once:
+    dropoff_osmid, dropoff_dist = index.snap(trips['Dropoff Centroid Longitude'], trips['Dropoff Centroid Latitude'])
+    pickup_osmid, pickup_dist = index.snap(trips['Pickup Centroid Longitude'], trips['Pickup Centroid Latitude'])
+
+    trips['dropoff_osmid'] = dropoff_osmid
+    trips['pickup_osmid'] = pickup_osmid
+    trips['dropoff_snap_dist'] = dropoff_dist
+    trips['pickup_snap_dist'] = pickup_dist
+    return trips
 
 
 def get_demand_trip(dirname,city, points, osm_mapping):
@@ -23,69 +44,218 @@ def get_demand_trip(dirname,city, points, osm_mapping):
     file_path = dirname + '/resources/demand_layer/demand_'+city+'.csv'
     results_df = pd.read_csv(file_path)
     if osm_mapping:
-        dropoff_osmid = []
-        pickup_osmid = []
-        # Find the closest OSM-node to origin and destination of each trip:
-        for i, row in results_df.iterrows():
-            try:
-                dropoff_osmid.append(points['geometry'].distance(
-                    Point(row['Dropoff Centroid Longitude'], row['Dropoff Centroid Latitude'])).idxmin())
-                pickup_osmid.append(points['geometry'].distance(
-                    Point(row['Pickup Centroid Longitude'], row['Pickup Centroid Latitude'])).idxmin())
-            except:
-                dropoff_osmid.append(float('nan'))
-                pickup_osmid.append(float('nan'))
-
-        results_df['dropoff_osmid'] = dropoff_osmid
-        results_df['pickup_osmid'] = pickup_osmid
+        snap_trips(results_df, spatial_index.NodeIndex(points))
     return results_df
 
-def map_osm_demandgeo(dirname,points):
-    """This function maps nodes of the street network to the demand layer regions. Only for Swiss cities."""
+
+def stream_demand_trip(dirname, city, points, osm_mapping, output_path, chunksize=100000, workers=1):
+    """This function does the same as get_demand_trip, but reads the demand file in chunks of chunksize trips and appends
+    each mapped chunk to output_path. Only a few chunks are held in memory, so the size of the demand file does not
+    matter. With workers > 1 the chunks are read, snapped and formatted in a process pool. The output is written as
+    parquet if output_path ends with .parquet, otherwise as csv. Returns the number of trips."""
+
+    # Directories
+    file_path = dirname + '/resources/demand_layer/demand_'+city+'.csv'
+    index = spatial_index.NodeIndex(points) if osm_mapping else None
+    parquet = output_path.endswith('.parquet')
+    if workers > 1:
+        chunks = parallel_chunks(file_path, index, chunksize, parquet, workers)
+    else:
+        chunks = serial_chunks(file_path, index, chunksize, parquet)
+    writer = None
+    rows = 0
+    start = time.time()
+    chunk_start = start
+    try:
+        if not parquet:
+            writer = open(output_path, 'w', newline='')
+        for i, (n, chunk) in enumerate(chunks):
+            if parquet:
+                writer = write_parquet_chunk(writer, chunk, output_path)
+            else:
+                writer.write(chunk)
+            rows += n
+            now = time.time()
+            print('Demand chunk %d: %d trips (%.0f trips/s), %d trips in total (%.0f trips/s)'
+                  % (i + 1, n, n / max(now - chunk_start, 1e-9), rows, rows / max(now - start, 1e-9)))
+            chunk_start = now
+    finally:
+        chunks.close()
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def process_chunk(chunk, index, first_row, parquet):
+    """This function snaps a chunk of trips, numbers its rows from first_row on and returns the number of trips together
+    with the chunk, or with the chunk as csv text if not written to parquet."""
+    if index is not None:
+        snap_trips(chunk, index)
+    chunk.index = pd.RangeIndex(first_row, first_row + len(chunk))
+    if parquet:
+        return len(chunk), chunk
+    return len(chunk), chunk.to_csv(header=first_row == 0)
+
+
+def serial_chunks(file_path, index, chunksize, parquet):
+    """This generator reads the demand file in chunks and processes them in this process."""
+    rows = 0
+    for chunk in pd.read_csv(file_path, chunksize=chunksize):
+        n, chunk = process_chunk(chunk, index, rows, parquet)
+        rows += n
+        yield n, chunk
+
+
+# Node index of a worker process, set once per worker by init_worker instead of being pickled with every task
+_shared_index = None
+
+
+def init_worker(index):
+    """This function sets the node index of a worker process."""
+    global _shared_index
+    _shared_index = index
+
+
+def process_byte_range(file_path, columns, start, end, first_row, parquet):
+    """This function reads the trips between two byte offsets of the demand file and processes them with the shared
+    node index."""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    try:
+        chunk = pd.read_csv(io.BytesIO(data), header=None, names=columns)
+    except pd.errors.EmptyDataError:
+        chunk = pd.DataFrame(columns=columns)
+    return process_chunk(chunk, _shared_index, first_row, parquet)
+
+
+def byte_ranges(file_path, chunksize):
+    """This generator splits the demand file into byte ranges of about chunksize lines. Each range starts at the
+    beginning of a line, the header line is skipped. Yields start, end and the number of the first trip of each
+    range."""
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.readline()
+        start = f.tell()
+        sample = [line for line in (f.readline() for _ in range(1000)) if line]
+        step = max(int(sum(map(len, sample)) / max(len(sample), 1) * chunksize), 1)
+        first_row = 0
+        while start < size:
+            f.seek(min(start + step, size))
+            f.readline()
+            end = f.tell()
+            yield start, end, first_row
+            f.seek(start)
+            first_row += f.read(end - start).count(b'\n')
+            start = end
+
+
+def parallel_chunks(file_path, index, chunksize, parquet, workers):
+    """This generator shards the demand file into byte ranges and processes them in a pool of worker processes. The
+    chunks are returned in input order and at most two chunks per worker are in flight at any time. Each pool gets its
+    own index through the initializer, so several demand files can be streamed at the same time. Workers are only
+    forked if no other threads run in this process (e.g. layers run by the scheduler), otherwise they are spawned."""
+    columns = list(pd.read_csv(file_path, nrows=0).columns)
+    if 'fork' in multiprocessing.get_all_start_methods() and threading.active_count() == 1:
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+    pool = context.Pool(workers, initializer=init_worker, initargs=(index,))
+    try:
+        pending = deque()
+        for start, end, first_row in byte_ranges(file_path, chunksize):
+            pending.append(pool.apply_async(process_byte_range,
+                                            (file_path, columns, start, end, first_row, parquet)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def write_parquet_chunk(writer, chunk, output_path):
+    """This function appends a chunk of trips to a parquet file and returns the writer. The schema is fixed by the first
+    chunk, with integer columns widened to float and empty columns to string, as later chunks may contain missing
+    values there."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if writer is None:
+        schema = pa.Table.from_pandas(chunk, preserve_index=False).schema
+        for i, field in enumerate(schema):
+            if pa.types.is_integer(field.type):
+                schema = schema.set(i, pa.field(field.name, pa.float64()))
+            elif pa.types.is_null(field.type):
+                schema = schema.set(i, pa.field(field.name, pa.string()))
+        writer = pq.ParquetWriter(output_path, schema)
+    writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False, safe=False))
+    return writer
+
+def load_zones(dirname):
+    """This function returns the NPVM 2017 traffic zones (ID_Gem, N_KT and geometry). The zones are extracted from the
+    zip archive only once and then stored as parquet in resources/demand_layer/cache, keyed by the hash of the archive.
+    If the archive changes, the cache is rebuilt."""
 
     # Directories
     file_path = dirname + '/resources/demand_layer/Verkehrszonen_Schweiz_NPVM_2017.zip'
-    dir_unzip = dirname + '/resources/demand_layer'
-    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-        zip_ref.extractall(dir_unzip)
-    file_path = dirname + '/resources/demand_layer/Verkehrszonen_Schweiz_NPVM_2017_gpkg.zip'
-    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-        zip_ref.extractall(dir_unzip)
-    file_path = dirname + '/resources/demand_layer/Verkehrszonen_Schweiz_NPVM_2017.gpkg'
-    # Kanton of city, change if other then ZH!
-    kanton = 'ZH' # TODO ask this in the UI
-    # Load data from files
-    data = gpd.read_file(file_path)
-    data = data[data['N_KT'] == kanton]
-    data.drop_duplicates()
-    # Transform coordinate frame
-    transformer = Transformer.from_crs(4326, 2056)
-    points_geox = np.array([point.x for point in points['geometry']])
-    points_geoy = np.array([point.y for point in points['geometry']])
-    transformed_p = transformer.transform(points_geox, points_geoy)
-    Tracts = data['ID_Gem']
-    tract = np.empty(len(points), dtype=int)
-    Polygons = data['geometry']
-    # Mapping of street layer nodes to regions
-    for i in range(len(transformed_p[0])):
-        point = Point(transformed_p[0][i], transformed_p[1][i])
-        for j, poly in enumerate(Polygons):
-            if poly.contains(point):
-                tract[i] = Tracts[j]
-
-    """ 
-    old:
-    tracts = pd.DataFrame(tract, columns=['demand_layer_region_id'])
-    points_df = pd.DataFrame(points)
-    points_df = points_df.reset_index(drop=True)
-    objs = [points_df, tracts]
-    return pd.concat(objs, axis=1)
-    """
-    points['demand_layer_region_id'] = tract
-    return points
+    cache_path = dirname + '/resources/demand_layer/cache'
+    digest = storage.file_hash(file_path, cache_path)
+    cached_path = os.path.join(cache_path, 'npvm_zones_' + digest[:16] + '.parquet')
+    if os.path.isfile(cached_path):
+        return storage.read_frame(cached_path)
 
+    print('Extracting NPVM zones, they will be cached in ' + cached_path)
+    with tempfile.TemporaryDirectory() as dir_unzip:
+        with zipfile.ZipFile(file_path, 'r') as zip_ref:
+            zip_ref.extractall(dir_unzip)
+        gpkg_zip_path = os.path.join(dir_unzip, 'Verkehrszonen_Schweiz_NPVM_2017_gpkg.zip')
+        with zipfile.ZipFile(gpkg_zip_path, 'r') as zip_ref:
+            zip_ref.extractall(dir_unzip)
+        # Load data from files
+        data = gpd.read_file(os.path.join(dir_unzip, 'Verkehrszonen_Schweiz_NPVM_2017.gpkg'))
+    data = data[['ID_Gem', 'N_KT', 'geometry']]
+    storage.write_frame(data, cached_path)
+    # Remove zones of older versions of the archive, other processes may be removing them at the same time
+    for filename in os.listdir(cache_path):
+        if filename.startswith('npvm_zones_') and filename.endswith('.parquet') \
+                and filename != os.path.basename(cached_path):
+            try:
+                os.remove(os.path.join(cache_path, filename))
+            except FileNotFoundError:
+                pass
+    return data
+
+
+# Zone indices that have already been built in this process, keyed by the hash of the zone archive and kanton.
+_zone_indices = {}
 
 
+def get_zone_index(dirname, kanton=None):
+    """This function returns a spatial_index.RegionIndex over the NPVM 2017 traffic zones, labelled with ID_Gem. If kanton
+    is given, only the zones of that kanton are used. The index is built once per process and reused afterwards."""
 
+    # Directories
+    file_path = dirname + '/resources/demand_layer/Verkehrszonen_Schweiz_NPVM_2017.zip'
+    cache_path = dirname + '/resources/demand_layer/cache'
+    key = (storage.file_hash(file_path, cache_path), kanton)
+    if key not in _zone_indices:
+        data = load_zones(dirname)
+        if kanton is not None:
+            data = data[data['N_KT'] == kanton]
+        _zone_indices[key] = spatial_index.RegionIndex(data['geometry'], data['ID_Gem'])
+    return _zone_indices[key]
 
 
+def map_osm_demandgeo(dirname, points, kanton=None):
+    """This function maps nodes of the street network to the demand layer regions. Only for Swiss cities. By default
+    all zones of Switzerland are used, kanton (e.g. 'ZH') restricts the mapping to the zones of one kanton."""
+
+    zones = get_zone_index(dirname, kanton)
+    # Transform coordinate frame
+    ids, points_geox, points_geoy = spatial_index.node_coordinates(points)
+    transformed_p = spatial_index.transformer(4326, 2056).transform(points_geox, points_geoy)
+    # Mapping of street layer nodes to regions
+    tract = zones.assign(gpd.points_from_xy(transformed_p[0], transformed_p[1]))
+    points['demand_layer_region_id'] = tract.astype(int)
+    return points
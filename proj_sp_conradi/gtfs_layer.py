@@ -7,21 +7,25 @@
 # -----------------------------------------------------------
 
 import os
+import json
+import shutil
+import hashlib
+import zipfile
 import requests
 from shapely.geometry import Point, shape
 from collections import OrderedDict
 from proj_sp_conradi import utils
 
-import urbanaccess as ua
-from urbanaccess.gtfsfeeds import feeds
-from urbanaccess import gtfsfeeds
-
 # Pandana currently uses depreciated parameters in matplotlib, this hides the warning until its fixed
 import warnings
-import matplotlib.pyplot as plt
 
 warnings.filterwarnings("ignore")
 
+# Tables of a parsed feed that are cached, attributes of urbanaccess' gtfsfeeds_dfs
+FEED_TABLES = ['stops', 'routes', 'trips', 'stop_times', 'calendar', 'calendar_dates']
+# Days of the service calendar
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
 def nominatim_query(query):
     """
     This function gets the coordinates for a given city.
@@ -40,26 +44,215 @@ def nominatim_query(query):
     response_json = response.json()
     return shape(response_json[0]['geojson'])
 
-def download_store_gtfs(url, city, dirname, gtfs_edges_path, gtfs_nodes_path, stop_times_path, plot, path_fig_gtfs):
-    """This function creates and stores the GTFS graph."""
+def fetch_feed(url, zip_path, meta):
+    """
+    This function downloads the feed zip of url to zip_path, unless the server confirms with ETag or Last-Modified that
+    it is unchanged since the download described by meta. Returns the meta data of the zip: url, ETag, Last-Modified
+    and sha256 of the content. If the server cannot be reached, the zip downloaded before is used.
+    """
+    headers = {}
+    if os.path.isfile(zip_path) and meta.get('url') == url:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        response = requests.get(url, headers=headers, stream=True, timeout=60)
+        if response.status_code == 304:
+            print('GTFS feed has not changed since the last download')
+            return meta
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        if os.path.isfile(zip_path) and meta.get('url') == url:
+            print('GTFS feed could not be downloaded (' + repr(e) + '), using the feed downloaded before')
+            return meta
+        raise
+    print('Downloading GTFS feed from ' + url)
+    os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+    sha = hashlib.sha256()
+    tmp_path = zip_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for block in response.iter_content(1 << 20):
+            sha.update(block)
+            f.write(block)
+    os.replace(tmp_path, zip_path)
+    return {'url': url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+            'sha256': sha.hexdigest()}
+
+
+def extract_feed(zip_path, text_path):
+    """
+    This function extracts the text files of a feed zip to text_path. Files in sub folders of the zip are extracted to
+    text_path as well.
+    """
+    if os.path.isdir(text_path):
+        shutil.rmtree(text_path)
+    os.makedirs(text_path)
+    with zipfile.ZipFile(zip_path) as z:
+        for member in z.namelist():
+            if member.endswith('.txt') and not os.path.basename(member).startswith('.'):
+                with z.open(member) as src, open(os.path.join(text_path, os.path.basename(member)), 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+
+
+def cache_feed(dirname, city, url):
+    """
+    This function makes sure the parsed feed of a city is cached and returns the directory of the cached tables. The
+    feed zip is only downloaded if it changed (see fetch_feed). The parsed tables are cached as parquet in
+    resources/gtfs_feed/cache, keyed by the content of the zip and the urbanaccess version, so the text files (above
+    all stop_times.txt) are only parsed once per feed.
+    """
+    import urbanaccess as ua
+    from proj_sp_conradi import storage
 
-    # Parameter
-    stop_times = False # TODO ask this in UI
     # Directories
-    folder_path = 'resources/gtfs_feed'
-    folder_path_text = 'resources/gtfs_feed/gtfsfeed_text/' + city
-    download_path = os.path.join(dirname, folder_path)
-    text_path = os.path.join(dirname, folder_path_text)
-    # Download feed
-    feeds.add_feed(add_dict={city: url})
-    gtfsfeeds.download(data_folder=download_path)
+    folder_path = os.path.join(dirname, 'resources/gtfs_feed')
+    zip_path = os.path.join(folder_path, 'gtfsfeed_zips', city + '.zip')
+    text_path = os.path.join(folder_path, 'gtfsfeed_text', city)
+    cache_dir = os.path.join(folder_path, 'cache')
+    meta_path = os.path.join(cache_dir, 'feed_' + city + '.json')
+    meta = {}
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    meta = fetch_feed(url, zip_path, meta)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
 
-    # Create graph
+    key = hashlib.sha1((meta['sha256'] + ua.__version__).encode()).hexdigest()[:16]
+    tables_dir = os.path.join(cache_dir, 'feed_' + city + '_' + key)
+    if os.path.isdir(tables_dir):
+        print('Parsed GTFS feed found in ' + tables_dir)
+        return tables_dir
+
+    extract_feed(zip_path, text_path)
     loaded_feeds = ua.gtfs.load.gtfsfeed_to_df(gtfsfeed_path=text_path)
+    # Tables are written to a temporary directory first, so an interrupted run leaves no incomplete cache entry
+    tmp_dir = tables_dir + '.tmp'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for table in FEED_TABLES:
+        storage.write_frame(getattr(loaded_feeds, table), os.path.join(tmp_dir, table + '.parquet'))
+    os.replace(tmp_dir, tables_dir)
+    # Remove tables of older versions of the feed
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('feed_' + city + '_') and os.path.isdir(path) and path != tables_dir:
+            shutil.rmtree(path, ignore_errors=True)
+    return tables_dir
+
+
+def restore_feed(tables_dir):
+    """
+    This function reads the cached tables of a feed onto urbanaccess gtfsfeeds_dfs and returns it.
+    """
+    from urbanaccess.gtfs.gtfsfeeds_dataframe import gtfsfeeds_dfs
+    from proj_sp_conradi import storage
+
+    for table in FEED_TABLES:
+        setattr(gtfsfeeds_dfs, table, storage.read_frame(os.path.join(tables_dir, table + '.parquet')))
+    return gtfsfeeds_dfs
+
+
+def load_feed(dirname, city, url):
+    """
+    This function returns the parsed feed of a city as urbanaccess gtfsfeeds_dfs, see cache_feed.
+    """
+    return restore_feed(cache_feed(dirname, city, url))
+
+
+def parse_windows(windows):
+    """
+    This function parses time window specs like 'monday 07:00:00-10:00:00', given as list or comma-separated. The spec
+    'saturday hourly' stands for the 24 one hour windows of a day. Returns a list of (day, [start, end]).
+    """
+    if isinstance(windows, str):
+        windows = windows.split(',')
+    parsed = []
+    for spec in windows:
+        parts = spec.split()
+        if len(parts) != 2 or parts[0] not in DAYS:
+            raise ValueError('Invalid time window ' + repr(spec) + ', expected e.g. monday 07:00:00-10:00:00')
+        day = parts[0]
+        if parts[1] == 'hourly':
+            parsed += [(day, ['%02d:00:00' % h, '%02d:59:59' % h]) for h in range(24)]
+            continue
+        timerange = parts[1].split('-')
+        if len(timerange) != 2 or not all(len(t.split(':')) == 3 for t in timerange):
+            raise ValueError('Invalid time window ' + repr(spec) + ', expected e.g. monday 07:00:00-10:00:00')
+        parsed.append((day, timerange))
+    return parsed
+
+
+def window_path(path, day, timerange):
+    """
+    This function returns the path of the partition of a time window in the dataset of an output, e.g.
+    gtfs_edges_Zurich/day=monday/window=0700-1000/part-0.parquet for gtfs_edges_Zurich.parquet.
+    """
+    root, ext = os.path.splitext(path)
+    window = timerange[0].replace(':', '')[:4] + '-' + timerange[1].replace(':', '')[:4]
+    return os.path.join(root, 'day=' + day, 'window=' + window, 'part-0' + ext)
+
+
+def join_headways(nodes, headways):
+    """
+    This function joins the headways onto the nodes, one row per stop and route serving it.
+    """
+    headways = headways[['mean', 'unique_stop_id', 'unique_route_id']]
+    headways = headways.set_index('unique_stop_id')
+    nodes = nodes.join(headways)
+    nodes = nodes.rename(columns={"mean": "headways_mean"})
+    nodes = nodes.drop_duplicates()
+    return nodes
+
+
+def compact_headways(nodes, headways):
+    """
+    This function returns the nodes with one row per stop and integer stop codes, the headways as long table of stop
+    code, route code and mean headway, and the routes with their codes. Stops and routes are matched with categorical
+    codes instead of joining on the string ids.
+    """
+    import numpy as np
+    import pandas as pd
+
+    nodes = nodes.loc[~nodes.index.duplicated(), ['x', 'y']]
+    nodes['stop_code'] = np.arange(len(nodes), dtype='int32')
+    stops = pd.Categorical(headways['unique_stop_id'], categories=nodes.index)
+    routes = pd.Categorical(headways['unique_route_id'])
+    headways = pd.DataFrame({'stop_code': stops.codes.astype('int32'),
+                             'route_code': routes.codes.astype('int32'),
+                             'headways_mean': headways['mean'].to_numpy()})
+    # Headways of stops that are not in the network have code -1
+    headways = headways[headways['stop_code'] >= 0]
+    headways = headways.drop_duplicates(['stop_code', 'route_code']).sort_values(['stop_code', 'route_code'])
+    headways = headways.reset_index(drop=True)
+    routes = pd.DataFrame({'unique_route_id': routes.categories},
+                          index=pd.RangeIndex(len(routes.categories), name='route_code'))
+    return nodes, headways, routes
+
+
+def transit_network(loaded_feeds, day, timerange, compact=False, reuse=False):
+    """
+    This function creates the transit network of a parsed feed for one day and time window. Returns the edges and the
+    nodes with the headways of the routes serving them, with compact the edges and the three tables of
+    compact_headways. urbanaccess selects the trips of the day and interpolates their stop times (the expensive step,
+    it does not depend on the time window) into loaded_feeds.stop_times_int. With reuse these stop times, which must
+    be of the same day, are used again.
+    """
+    import urbanaccess as ua
+
+    # Stop times of another day are replaced
+    stop_times_int = getattr(loaded_feeds, 'stop_times_int', None)
+    overwrite = not reuse and stop_times_int is not None and not stop_times_int.empty
+    # Create graph
     ua.gtfs.network.create_transit_net(gtfsfeeds_dfs=loaded_feeds,
-                                       day='monday',
-                                       timerange=['07:00:00', '10:00:00'],
-                                       calendar_dates_lookup=None)
+                                       day=day,
+                                       timerange=timerange,
+                                       calendar_dates_lookup=None,
+                                       overwrite_existing_stop_times_int=overwrite,
+                                       use_existing_stop_times_int=reuse)
     urbanaccess_net = ua.network.ua_network
     edges = urbanaccess_net.transit_edges
     edges['geometry'] = 'NA'
@@ -68,26 +261,255 @@ def download_store_gtfs(url, city, dirname, gtfs_edges_path, gtfs_nodes_path, st
         ['node_id_from', 'node_id_to', 'geometry', 'route_type', 'lanes', 'weight', 'unique_trip_id', 'unique_route_id',
          'net_type']]
     # Calculate headways
-    headways = ua.gtfs.headways.headways(loaded_feeds, ['07:00:00', '10:00:00'])
+    headways = ua.gtfs.headways.headways(loaded_feeds, timerange)
     nodes = urbanaccess_net.transit_nodes
     nodes = nodes[['x', 'y']]
-    headways = headways.headways[['mean', 'unique_stop_id', 'unique_route_id']]
-    headways = headways.set_index('unique_stop_id')
-    # Store files
-    nodes = nodes.join(headways)
-    nodes = nodes.rename(columns={"mean": "headways_mean"})
-    nodes = nodes.drop_duplicates()
-    edges.to_csv(gtfs_edges_path)
-    nodes.to_csv(gtfs_nodes_path)
+    if compact:
+        return [edges] + list(compact_headways(nodes, headways.headways))
+    return [edges, join_headways(nodes, headways.headways)]
+
+
+# Parsed feed of a window worker process, see init_window_worker, and the day its interpolated stop times are of
+_window_feed = None
+_window_day = None
+
+
+def init_window_worker(tables_dir):
+    """
+    This function restores the parsed feed once per worker process of store_windows.
+    """
+    global _window_feed, _window_day
+    _window_feed = restore_feed(tables_dir)
+    _window_day = None
+
+
+def store_window(day, timeranges, paths):
+    """
+    This function creates the transit networks of time windows of one day with the feed of the worker process and
+    stores them in the partitions of the windows. The stop times of the day are interpolated only once per worker.
+    paths are the outputs as in transit_network, two or four with compact. Returns the number of edges per window.
+    """
+    from proj_sp_conradi import storage
+
+    global _window_day
+    counts = []
+    for timerange in timeranges:
+        frames = transit_network(_window_feed, day, timerange, compact=len(paths) > 2, reuse=_window_day == day)
+        _window_day = day
+        for frame, path in zip(frames, paths):
+            path = window_path(path, day, timerange)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            storage.write_layer(frame, path)
+        counts.append(len(frames[0]))
+    return counts
+
+
+def day_batches(windows, workers):
+    """
+    This function groups the windows by day and splits the windows of each day into at most workers batches of
+    consecutive windows. Returns a list of (day, [timerange, ...]).
+    """
+    days = OrderedDict()
+    for day, timerange in windows:
+        days.setdefault(day, []).append(timerange)
+    batches = []
+    for day, timeranges in days.items():
+        n = min(max(workers, 1), len(timeranges))
+        size = -(-len(timeranges) // n)
+        batches += [(day, timeranges[i:i + size]) for i in range(0, len(timeranges), size)]
+    return batches
+
+
+def store_windows(tables_dir, windows, paths, workers=1):
+    """
+    This function creates and stores the transit networks of several time windows from one parsed feed. The windows
+    are grouped by day and built by workers processes, each restores the parsed feed once and interpolates the stop
+    times of a day once for all windows of that day it builds. urbanaccess keeps the network in a module global, so
+    windows are never built by threads of the same process.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Each output is one dataset partitioned by day and window, old partitions are removed
+    for path in paths:
+        if os.path.isdir(os.path.splitext(path)[0]):
+            shutil.rmtree(os.path.splitext(path)[0])
+    batches = day_batches(windows, workers)
+    if workers <= 1:
+        init_window_worker(tables_dir)
+        counts = [store_window(day, timeranges, paths) for day, timeranges in batches]
+    else:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_window_worker, initargs=(tables_dir,)) as pool:
+            counts = list(pool.map(store_window, *zip(*batches), [paths] * len(batches)))
+    for (day, timeranges), batch_counts in zip(batches, counts):
+        for timerange, n in zip(timeranges, batch_counts):
+            print('Stored transit network for ' + day + ' ' + '-'.join(timerange) + ' with ' + str(n) + ' edges')
+
+
+def gtfs_seconds(times):
+    """
+    This function converts GTFS times (HH:MM:SS, hours can exceed 23 for trips after midnight) to seconds since midnight
+    of the service day. Missing or invalid times get -1.
+    """
+    import numpy as np
+    import pandas as pd
+
+    parts = pd.Series(times, dtype=object).astype(str).str.strip().str.split(':', expand=True)
+    if parts.shape[1] != 3:
+        return np.full(len(parts), -1, dtype='int32')
+    parts = parts.apply(pd.to_numeric, errors='coerce')
+    seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return seconds.fillna(-1).to_numpy().astype('int32')
 
-    if plot:
-        fig, ax = ua.plot.plot_net(nodes=urbanaccess_net.transit_nodes,
-                                edges=urbanaccess_net.transit_edges)
-        plt.savefig(path_fig_gtfs)
 
-    if stop_times:
-        stop_times = loaded_feeds.stop_times
-        stop_times.to_csv(stop_times_path)
+def service_calendar(trips, calendar, trip_ids):
+    """
+    This function returns the service of each trip in trip_ids as int32 code (-1 if the trip is not in trips), the
+    service ids of the codes and whether each service runs on each day of DAYS (array of shape services x 7). The days
+    are selected as urbanaccess does (create_transit_net without calendar_dates_lookup): by the weekday columns of
+    calendar only, services that are not in calendar never run.
+    """
+    import numpy as np
+    import pandas as pd
+
+    trip_column = 'unique_trip_id' if 'unique_trip_id' in trips.columns else 'trip_id'
+    service_column = 'unique_service_id' if 'unique_service_id' in trips.columns and \
+        'unique_service_id' in calendar.columns else 'service_id'
+    trip_services = trips.set_index(trips[trip_column].astype(str))[service_column].astype(str)
+    trip_services = trip_services[~trip_services.index.duplicated()]
+    services = pd.Categorical(pd.Series(trip_ids).map(trip_services))
+    codes = services.codes.astype('int32')
+    days = np.zeros((len(services.categories), len(DAYS)), dtype=bool)
+    if len(calendar) and service_column in calendar.columns:
+        calendar = calendar.set_index(calendar[service_column].astype(str))
+        calendar = calendar[~calendar.index.duplicated()]
+        calendar = calendar.reindex(services.categories)
+        for i, day in enumerate(DAYS):
+            if day in calendar.columns:
+                days[:, i] = pd.to_numeric(calendar[day], errors='coerce').to_numpy() == 1
+    return codes, services.categories, days
+
+
+def store_timetable(stop_times, trips, calendar, path, ext='.csv'):
+    """
+    This function stores the stop times of a feed as timetable in the directory path, for lookups like the next
+    departures from a stop after some time. Stops, trips and services are coded as int32 ids (stops, trips and services
+    tables, format given by ext), times as int32 seconds since midnight. The rows are sorted by stop and departure and
+    stored as one .npy array per column (stop, trip, service, departure, arrival, stop_sequence) that can be
+    memory-mapped, offsets[s] to offsets[s + 1] are the rows of stop s. The timetable holds the stop times of all
+    service days, calendar.npy tells on which days of DAYS each service runs (see service_calendar), so lookups for a
+    day keep the rows with calendar[service, DAYS.index(day)]. Stop times without any time are left out. See
+    load_timetable and next_departures.
+    """
+    import numpy as np
+    import pandas as pd
+    from proj_sp_conradi import storage
+
+    stop_column = 'unique_stop_id' if 'unique_stop_id' in stop_times.columns else 'stop_id'
+    trip_column = 'unique_trip_id' if 'unique_trip_id' in stop_times.columns else 'trip_id'
+    departure = gtfs_seconds(stop_times['departure_time'])
+    arrival = gtfs_seconds(stop_times['arrival_time'])
+    departure = np.where(departure < 0, arrival, departure)
+    arrival = np.where(arrival < 0, departure, arrival)
+    keep = departure >= 0
+    stops = pd.Categorical(stop_times[stop_column].astype(str)[keep])
+    trips_codes = pd.Categorical(stop_times[trip_column].astype(str)[keep])
+    trip_services, services, days = service_calendar(trips, calendar, trips_codes.categories)
+    columns = {'stop': stops.codes.astype('int32'),
+               'trip': trips_codes.codes.astype('int32'),
+               'service': trip_services[trips_codes.codes],
+               'departure': departure[keep],
+               'arrival': arrival[keep],
+               'stop_sequence': pd.to_numeric(stop_times['stop_sequence'][keep], errors='coerce')
+                   .fillna(-1).to_numpy().astype('int32')}
+    order = np.lexsort((columns['departure'], columns['stop']))
+    offsets = np.zeros(len(stops.categories) + 1, dtype='int64')
+    offsets[1:] = np.cumsum(np.bincount(columns['stop'], minlength=len(stops.categories)))
+
+    # The timetable is written to a temporary directory first and then replaces the old one
+    tmp_path = storage.tmp_path_of(path)
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), values[order])
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp_path, 'calendar.npy'), days)
+    storage.write_layer(pd.DataFrame({stop_column: stops.categories}, index=pd.RangeIndex(
+        len(stops.categories), name='stop')), os.path.join(tmp_path, 'stops' + ext))
+    storage.write_layer(pd.DataFrame({trip_column: trips_codes.categories}, index=pd.RangeIndex(
+        len(trips_codes.categories), name='trip')), os.path.join(tmp_path, 'trips' + ext))
+    storage.write_layer(pd.DataFrame(dict({'service_id': services}, **{day: days[:, i] for i, day in enumerate(DAYS)}),
+                                     index=pd.RangeIndex(len(services), name='service')),
+                        os.path.join(tmp_path, 'services' + ext))
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    print('Stored timetable with ' + str(int(keep.sum())) + ' stop times of ' + str(len(stops.categories))
+          + ' stops and ' + str(len(services)) + ' services in ' + path)
+
+
+def load_timetable(path):
+    """
+    This function opens a timetable stored by store_timetable. Returns a dict of the arrays, memory-mapped, so only the
+    rows that are looked up are read.
+    """
+    import numpy as np
+
+    names = ['stop', 'trip', 'service', 'departure', 'arrival', 'stop_sequence', 'offsets', 'calendar']
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in names}
+
+
+def next_departures(timetable, stop, time, n=5, day=None):
+    """
+    This function returns the row numbers of the next n departures from stop (int id) at or after time (seconds since
+    midnight) in a timetable opened by load_timetable. If day (one of DAYS) is given, only trips whose service runs on
+    that day are returned, otherwise the departures of all service days.
+    """
+    import numpy as np
+
+    start, end = int(timetable['offsets'][stop]), int(timetable['offsets'][stop + 1])
+    first = start + int(np.searchsorted(timetable['departure'][start:end], time))
+    if day is None:
+        return np.arange(first, min(first + n, end))
+    runs = np.asarray(timetable['calendar'][:, DAYS.index(day)])
+    service = np.asarray(timetable['service'][first:end])
+    # Trips without a service (-1) never run
+    running = (service >= 0) & runs[np.maximum(service, 0)]
+    return first + np.flatnonzero(running)[:n]
+
+
+def download_store_gtfs(url, city, dirname, gtfs_edges_path, gtfs_nodes_path, timetable_path=None, windows=None,
+                        workers=1, headways_path=None, routes_path=None):
+    """This function creates and stores the GTFS graph. The output format is chosen by the file extension of the paths
+    (csv or parquet). The graph is plotted from the stored output by plotting.plot_gtfs. By default the network is built
+    for monday 07:00:00-10:00:00. If windows (see parse_windows) are given, the networks of all windows are built from
+    one parse of the feed by workers processes and stored as datasets partitioned by day and window, see window_path.
+    If headways_path and routes_path are given, the nodes are stored with one row per stop and the headways per stop
+    and route in a separate table, see compact_headways. If timetable_path is given, the stop times of the feed are
+    stored there as timetable of all service days, see store_timetable.
+    """
+    from proj_sp_conradi import storage
+
+    # Download feed if it changed, and parse it unless it is cached
+    tables_dir = cache_feed(dirname, city, url)
+    paths = [gtfs_edges_path, gtfs_nodes_path]
+    if headways_path is not None and routes_path is not None:
+        paths += [headways_path, routes_path]
+
+    if windows:
+        store_windows(tables_dir, parse_windows(windows), paths, workers)
+    else:
+        frames = transit_network(restore_feed(tables_dir), 'monday', ['07:00:00', '10:00:00'], len(paths) > 2)
+        # Store files
+        for frame, path in zip(frames, paths):
+            storage.write_layer(frame, path)
+
+    if timetable_path is not None:
+        tables = [storage.read_frame(os.path.join(tables_dir, table + '.parquet'))
+                  for table in ['stop_times', 'trips', 'calendar']]
+        store_timetable(*tables, timetable_path, os.path.splitext(gtfs_nodes_path)[1])
 
 
 def get_gtfs_url(city):
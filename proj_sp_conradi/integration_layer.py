@@ -0,0 +1,121 @@
+# -----------------------------------------------------------
+# This module connects the GTFS public transport layer to the
+# OSM street layer and stores the integrated network.
+#
+#
+# Johannes Conradi, 2020 ETH Zuerich
+# email: conradij@ethz.ch
+# -----------------------------------------------------------
+
+import glob
+import os
+import numpy as np
+import pandas as pd
+from proj_sp_conradi import spatial_index
+
+# Walking speed on connector edges in m/s (3 mph, as urbanaccess)
+WALK_SPEED = 1.34
+# Stops further away from the closest street node are not connected, in meters
+MAX_CONNECTOR_LENGTH = 1000
+
+
+def read_gtfs(nodes_path, edges_path):
+    """
+    This function reads the stops and connections of the stored GTFS layer, csv or parquet. If the layer was built for
+    several time windows, the first partition of the datasets is read (see gtfs_layer.window_path).
+    """
+    from proj_sp_conradi import plotting
+
+    frames = []
+    for path, columns in [(nodes_path, ['x', 'y']), (edges_path, ['node_id_from', 'node_id_to', 'weight'])]:
+        if not os.path.isfile(path):
+            root, ext = os.path.splitext(path)
+            path = sorted(glob.glob(os.path.join(root, 'day=*', 'window=*', 'part-0' + ext)))[0]
+        frames.append(plotting.read_columns(path, columns))
+    nodes, edges = frames
+    # The nodes are stored once per route serving the stop
+    nodes = nodes[~nodes.index.duplicated()]
+    return nodes, edges
+
+
+def street_nodes(osm_edges):
+    """
+    This function returns the nodes of the street layer as the end points of its edges, indexed by osm id with x and y.
+    The merged intersections of a simplified graph have ids of their own that the edges do not refer to, so the nodes
+    are taken from the edges (as in osm_layer.export_csr) and every node is reached by a drive edge.
+    """
+    start = [g.coords[0] for g in osm_edges['geometry']]
+    end = [g.coords[-1] for g in osm_edges['geometry']]
+    nodes = pd.DataFrame({'x': [c[0] for c in start + end], 'y': [c[1] for c in start + end]},
+                         index=np.concatenate([osm_edges['u'].to_numpy(dtype=np.int64),
+                                               osm_edges['v'].to_numpy(dtype=np.int64)]))
+    return nodes[~nodes.index.duplicated()]
+
+
+def connect_stops(nodes, stops, max_length=MAX_CONNECTOR_LENGTH):
+    """
+    This function snaps all stops to the closest street node (see street_nodes) at once with a KD-tree over the nodes
+    in the UTM zone of the city. Returns the connector edges in both directions with their walk length in meters and
+    walk time in seconds. Stops further away than max_length are not connected.
+    """
+    import geopandas as gpd
+
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(nodes['x'], nodes['y']), index=nodes.index)
+    crs = spatial_index.utm_crs(np.median(nodes['x']), np.median(nodes['y']))
+    index = spatial_index.NodeIndex(points, crs=crs)
+    osm_ids, length = index.snap(stops['x'], stops['y'])
+    connected = np.isfinite(length) & (length <= max_length)
+    stop_ids = stops.index.to_numpy()[connected].astype(str)
+    osm_ids = osm_ids[connected].astype(np.int64).astype(str)
+    length = length[connected]
+    connectors = pd.DataFrame({'node_id_from': np.concatenate([stop_ids, osm_ids]),
+                               'node_id_to': np.concatenate([osm_ids, stop_ids]),
+                               'length': np.concatenate([length, length])})
+    connectors['time'] = connectors['length'] / WALK_SPEED
+    connectors['net_type'] = 'connector'
+    print('Connected ' + str(int(connected.sum())) + ' of ' + str(len(stops)) + ' stops to the street layer')
+    return connectors
+
+
+def integrate_networks(osm_edges, stops, transit_edges, max_length=MAX_CONNECTOR_LENGTH):
+    """
+    This function combines the street layer, the transit network and the connectors between them into one network
+    (like urbanaccess' integrated network). Node ids are strings, osm ids for street nodes and the GTFS stop ids for
+    stops. Edges have length in meters (unknown for transit edges), time in seconds and net_type drive, transit or
+    connector.
+    """
+    drive_nodes = street_nodes(osm_edges)
+    nodes = pd.concat([
+        pd.DataFrame({'x': drive_nodes['x'].to_numpy(), 'y': drive_nodes['y'].to_numpy(), 'net_type': 'drive'},
+                     index=drive_nodes.index.astype(str)),
+        pd.DataFrame({'x': stops['x'].to_numpy(dtype=float), 'y': stops['y'].to_numpy(dtype=float),
+                      'net_type': 'transit'}, index=stops.index.astype(str))])
+    nodes.index.name = 'node_id'
+    drive = pd.DataFrame({'node_id_from': osm_edges['u'].to_numpy().astype(np.int64).astype(str),
+                          'node_id_to': osm_edges['v'].to_numpy().astype(np.int64).astype(str),
+                          'length': osm_edges['length'].to_numpy(dtype=float),
+                          'time': osm_edges['time'].to_numpy(dtype=float) if 'time' in osm_edges else np.nan,
+                          'net_type': 'drive'})
+    # urbanaccess gives the travel time of transit edges in minutes
+    transit = pd.DataFrame({'node_id_from': transit_edges['node_id_from'].astype(str).to_numpy(),
+                            'node_id_to': transit_edges['node_id_to'].astype(str).to_numpy(),
+                            'length': np.nan,
+                            'time': pd.to_numeric(transit_edges['weight'], errors='coerce').to_numpy() * 60,
+                            'net_type': 'transit'})
+    connectors = connect_stops(drive_nodes, stops, max_length)
+    edges = pd.concat([drive, transit, connectors], ignore_index=True)
+    return nodes, edges
+
+
+def store_integrated(osm_edges, gtfs_nodes_path, gtfs_edges_path, nodes_path, edges_path):
+    """
+    This function integrates the stored GTFS layer with the street layer and stores the combined nodes and edges. The
+    format is chosen by the file extension of the paths (csv or parquet).
+    """
+    from proj_sp_conradi import storage
+
+    stops, transit_edges = read_gtfs(gtfs_nodes_path, gtfs_edges_path)
+    nodes, edges = integrate_networks(osm_edges, stops, transit_edges)
+    storage.write_layer(nodes, nodes_path)
+    storage.write_layer(edges, edges_path)
+    print('Stored integrated network with ' + str(len(nodes)) + ' nodes and ' + str(len(edges)) + ' edges')
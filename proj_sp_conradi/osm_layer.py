@@ -8,10 +8,13 @@
 
 import osmnx as ox
 import numpy as np
-from shapely.geometry import Point
+import pandas as pd
+import geopandas as gpd
+import networkx as nx
 import os
-import matplotlib.pyplot as plt
-import pyproj
+import json
+from proj_sp_conradi import spatial_index
+from proj_sp_conradi import storage
 
 
 
@@ -25,7 +28,7 @@ def get_store_osm(folder_path, filename, city, n_type):
     # Save as graph ml
     ox.save_graphml(G, filename=filename, folder=folder_path, gephi=False)
 
-def simplify_graph(G, simplify, tol, plot, path_fig_osm):
+def simplify_graph(G, simplify, tol):
     """
     This function either simplifies the OSM graph with ox.simplify_graph or with both ox.simplify_graph and
     ox.clean_intersections.
@@ -34,45 +37,138 @@ def simplify_graph(G, simplify, tol, plot, path_fig_osm):
     # If not supposed to simplify, still use osmnx function to simplify.
     if not simplify:
         G = ox.simplify_graph(G)
-        if plot:
-            fig, ax = ox.plot_graph(G, fig_height=10, show=False, close=False)
-            plt.savefig(path_fig_osm)
         points = ox.graph_to_gdfs(G, nodes=True, edges=False)
         edges = ox.graph_to_gdfs(G, nodes=False, edges=True)
         #return points[['osmid', 'geometry']], edges[['u', 'v', 'geometry', 'highway', 'lanes', 'length',  'name', 'oneway', 'maxspeed']]
-        return points[['osmid', 'geometry']], edges[['u', 'v', 'geometry', 'highway', 'lanes', 'length', 'name', 'oneway', 'maxspeed']]
+        return points[['osmid', 'geometry']], edges[['u', 'v', 'key', 'geometry', 'highway', 'lanes', 'length', 'name', 'oneway', 'maxspeed']]
 
     # If supposed to simplify use both osmnx function to simplify as well as clean_intersections to merge multiple
     # nodes on intersections.
     else:
         print("Simplifying graph...")
-        proj_wgs84 = pyproj.Proj(init="epsg:4326")
-        proj_gk4 = pyproj.Proj(init="epsg:31468")
-        # Project graph to get nodes in meter
-        G_proj = ox.project_graph(G, to_crs="epsg:31468")
+        # Project graph to the UTM zone of the city to get nodes in meter
+        lon = np.median([data['x'] for _, data in G.nodes(data=True)])
+        lat = np.median([data['y'] for _, data in G.nodes(data=True)])
+        crs = spatial_index.utm_crs(lon, lat)
+        G_proj = ox.project_graph(G, to_crs=crs)
         # Simplify graph
         G2 = ox.simplify_graph(G_proj)
         # Get merged nodes that are not closer than tolerance
         intersections = ox.clean_intersections(G2, tolerance=tol, dead_ends=False) #TODO: New version of ox has funciton called consolidate_intersections, implement that
-        points = np.array([point.xy for point in intersections])
-        for i, point in enumerate(points):
-            points[i] = pyproj.transform(proj_gk4, proj_wgs84, point[0], point[1])
-            intersections[i] = Point(points[i, 1, 0], points[i, 0, 0])
+        # Transform all merged nodes back to lat/long at once
+        lon, lat = spatial_index.transformer(crs, 'epsg:4326').transform(intersections.x.to_numpy(),
+                                                                           intersections.y.to_numpy())
+        intersections = gpd.GeoSeries(gpd.points_from_xy(lon, lat), index=intersections.index, crs='epsg:4326')
         # Project graph back to degrees
-        G3 = ox.project_graph(G2, to_crs={'init': 'epsg:4326'})
+        G3 = ox.project_graph(G2, to_crs='epsg:4326')
 
         # Get edges Graph in lat/long
         edges = ox.graph_to_gdfs(G3, nodes=False, edges=True)
-        if plot:
-            fig, ax = ox.plot_graph(G3, fig_height=10, show=False, close=False, node_alpha=0)
-            ax.scatter(x=points[:, 0], y=points[:, 1], zorder=2, color='#66ccff', edgecolors='k')
-            plt.savefig(path_fig_osm)
 
-        return intersections, edges[['u', 'v', 'geometry', 'highway', 'lanes', 'length',  'name', 'oneway', 'maxspeed']]
+        return intersections, edges[['u', 'v', 'key', 'geometry', 'highway', 'lanes', 'length',  'name', 'oneway', 'maxspeed']]
 
 
-def get_osm(dirname, city, simplify, tolerance, plot, path_fig_osm):
-    """"This function works as the main for the osm layer."""
+def export_csr(points, edges, path):
+    """
+    This function writes the road network as compressed sparse row adjacency to the directory path. Node indices are
+    int32, osmid.npy maps each node index to its osmid. The edges of node i are indices[indptr[i]:indptr[i + 1]], their
+    length, speed and time are stored as float32 arrays in the same order and edge.npy gives the row of each edge in
+    edges. All arrays are .npy files, so they can be memory-mapped with load_csr.
+    """
+    u = edges['u'].to_numpy(dtype=np.int64)
+    v = edges['v'].to_numpy(dtype=np.int64)
+    node_ids = [u, v]
+    if isinstance(points, pd.DataFrame) and 'osmid' in points:
+        node_ids.append(points['osmid'].to_numpy(dtype=np.int64))
+    osmid = np.unique(np.concatenate(node_ids))
+    src = np.searchsorted(osmid, u)
+    dst = np.searchsorted(osmid, v)
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(len(osmid) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=len(osmid)))
+    arrays = {'indptr': indptr,
+              'indices': dst[order].astype(np.int32),
+              'osmid': osmid,
+              'edge': order.astype(np.int32)}
+    for attribute in ['length', 'speed', 'time']:
+        if attribute in edges:
+            arrays[attribute] = edges[attribute].to_numpy(dtype=np.float32)[order]
+        else:
+            arrays[attribute] = np.full(len(order), np.nan, dtype=np.float32)
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+    print('CSR adjacency with ' + str(len(osmid)) + ' nodes and ' + str(len(order)) + ' edges stored in ' + path)
+
+
+def load_csr(path, mmap=True):
+    """
+    This function loads the arrays written by export_csr as dict. With mmap the arrays are memory-mapped read-only
+    instead of read into memory.
+    """
+    arrays = {}
+    for filename in os.listdir(path):
+        if filename.endswith('.npy'):
+            arrays[filename[:-4]] = np.load(os.path.join(path, filename), mmap_mode='r' if mmap else None)
+    return arrays
+
+
+def cache_paths(folder_path, name):
+    """
+    This function returns the paths of the node file, the edge file and the graph attribute file of a graph cache entry.
+    """
+    cache_path = os.path.join(folder_path, 'cache')
+    return (os.path.join(cache_path, name + '_nodes.parquet'), os.path.join(cache_path, name + '_edges.parquet'),
+            os.path.join(cache_path, name + '_graph.json'))
+
+
+def save_graph(G, folder_path, name):
+    """
+    This function stores a graph as parquet node and edge tables in the cache of the resource directory. The number of
+    streets per node (used by ox.clean_intersections) is stored as node column, so the node ids keep their type.
+    """
+    nodes_path, edges_path, graph_path = cache_paths(folder_path, name)
+    nodes = pd.DataFrame.from_dict(dict(G.nodes(data=True)), orient='index')
+    graph = dict(G.graph)
+    streets_per_node = graph.pop('streets_per_node', None)
+    if streets_per_node is not None:
+        nodes['_streets_per_node'] = [streets_per_node.get(node, np.nan) for node in nodes.index]
+    edges = pd.DataFrame([dict(data, u=u, v=v, key=key) for u, v, key, data in G.edges(keys=True, data=True)])
+    if 'geometry' in edges:
+        edges['geometry'] = gpd.GeoSeries([None if storage.is_null(g) else g for g in edges['geometry']])
+    os.makedirs(os.path.dirname(nodes_path), exist_ok=True)
+    storage.write_frame(nodes, nodes_path)
+    storage.write_frame(edges, edges_path)
+    with open(graph_path, 'w') as f:
+        json.dump(graph, f, default=str)
+
+
+def load_graph(folder_path, name):
+    """
+    This function loads a graph stored with save_graph.
+    """
+    nodes_path, edges_path, graph_path = cache_paths(folder_path, name)
+    with open(graph_path) as f:
+        G = nx.MultiDiGraph(**json.load(f))
+    nodes = storage.read_frame(nodes_path)
+    edges = storage.read_frame(edges_path)
+    if '_streets_per_node' in nodes:
+        count = nodes.pop('_streets_per_node')
+        G.graph['streets_per_node'] = {node: int(c) for node, c in zip(nodes.index, count) if not storage.is_null(c)}
+    G.add_nodes_from((node, {k: v for k, v in data.items() if not storage.is_null(v)})
+                     for node, data in zip(nodes.index, nodes.to_dict('records')))
+    G.add_edges_from((data.pop('u'), data.pop('v'), data.pop('key'), {k: v for k, v in data.items()
+                                                                       if not storage.is_null(v)})
+                     for data in edges.to_dict('records'))
+    return G
+
+
+def get_osm(dirname, city, simplify, tolerance):
+    """"This function works as the main for the osm layer. The downloaded graph as well as the simplified or consolidated
+    nodes and edges are cached as parquet in resources/osm_graph/cache, keyed by city, network type, simplify,
+    tolerance and the content of the downloaded GraphML, so later runs neither parse the GraphML nor simplify again and
+    a new download replaces all cache entries of the city. The graph is plotted from the stored output by
+    plotting.plot_osm."""
     # Network type
     n_type = 'drive'
     # Construct directories
@@ -80,21 +176,49 @@ def get_osm(dirname, city, simplify, tolerance, plot, path_fig_osm):
     filename = city + '.graphml'
     folder_path = os.path.join(dirname, osm_graph_path)
     file_path = os.path.join(folder_path, filename)
-    # Check if data has already been downloaded
-    if os.path.isfile(file_path):
-        print('OSM data has already been downloaded and stored in ' + file_path)
-        # Gets OSM layer from file
-        print('Will load data in app...')
-        G = ox.load_graphml(filename=filename, folder=folder_path)
-    else:
+    cache_path = os.path.join(folder_path, 'cache')
+    if not os.path.isfile(file_path):
         print('OSM data has not been downloaded. It will be downloaded and stored in ' + file_path)
         try:
             # Download data
             get_store_osm(folder_path, filename, city, n_type)
-            # Gets OSM layer from file
-            G = ox.load_graphml(filename=filename, folder=folder_path)
             print('Successfully downloaded and stored')
         except:
             print('Error while downloading and storing')
-    return simplify_graph(G, simplify, tolerance, plot, path_fig_osm)
-
+    # Cache entries belong to the downloaded GraphML
+    key = storage.file_hash(file_path, cache_path)[:16]
+    prefix = city + '_' + n_type + '_'
+    raw_name = prefix + 'raw_' + key
+    if simplify:
+        name = prefix + 'consolidated_' + str(tolerance) + '_' + key
+    else:
+        name = prefix + 'simplified_' + key
+    nodes_path, edges_path, graph_path = cache_paths(folder_path, name)
+    # Check if the graph has already been processed
+    if os.path.isfile(nodes_path) and os.path.isfile(edges_path):
+        print('OSM data has already been processed and stored in ' + os.path.dirname(nodes_path))
+        points = storage.read_frame(nodes_path)
+        if simplify:
+            points = points['geometry']
+        return points, storage.read_frame(edges_path)
+    # Check if data has already been read from the GraphML
+    if os.path.isfile(cache_paths(folder_path, raw_name)[2]):
+        print('OSM data has already been downloaded and stored in ' + os.path.dirname(nodes_path))
+        G = load_graph(folder_path, raw_name)
+    else:
+        print('OSM data has already been downloaded and stored in ' + file_path)
+        # Gets OSM layer from file
+        print('Will load data in app...')
+        G = ox.load_graphml(filename=filename, folder=folder_path)
+        save_graph(G, folder_path, raw_name)
+    # Remove cache entries of older downloads
+    for cached in os.listdir(cache_path):
+        if cached.startswith(prefix) and '_' + key + '_' not in cached:
+            try:
+                os.remove(os.path.join(cache_path, cached))
+            except FileNotFoundError:
+                pass
+    points, edges = simplify_graph(G, simplify, tolerance)
+    storage.write_frame(points, nodes_path)
+    storage.write_frame(edges, edges_path)
+    return points, edges
@@ -0,0 +1,108 @@
+# -----------------------------------------------------------
+# This module plots the street and public transport layers
+# from the stored outputs, without a display.
+#
+#
+# Johannes Conradi, 2020 ETH Zuerich
+# email: conradij@ethz.ch
+# -----------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+# Graphs with more edges are drawn decimated: straight segments between the end points, rasterized and without nodes
+DECIMATE_EDGES = 100000
+
+
+def read_columns(path, columns):
+    """
+    This function reads some columns (and the index) of an output file, csv or parquet. Geometries in csv files are
+    parsed from WKT.
+    """
+    if path.endswith('.parquet'):
+        from proj_sp_conradi import storage
+        return storage.read_frame(path, columns=columns)
+    from shapely import wkt
+    index = pd.read_csv(path, nrows=0).columns[0]
+    df = pd.read_csv(path, index_col=0, usecols=[index] + list(columns))
+    if 'geometry' in df.columns:
+        df['geometry'] = [wkt.loads(g) if isinstance(g, str) else None for g in df['geometry']]
+    return df
+
+
+def new_figure(height=10):
+    """
+    This function returns a figure drawn by the Agg backend and its axes. The figure is not registered with pyplot,
+    so it is freed as soon as it is no longer used and no display is needed.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(height, height))
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_aspect('equal')
+    return fig, ax
+
+
+def draw_segments(ax, segments, decimate, color, linewidth):
+    """Helper function, to draw lines given as list of coordinate arrays"""
+    from matplotlib.collections import LineCollection
+
+    ax.add_collection(LineCollection(segments, colors=color, linewidths=linewidth * (0.3 if decimate else 1),
+                                     rasterized=decimate))
+    ax.autoscale_view()
+
+
+def plot_osm(edges_path, path_fig, nodes_path=None, decimate=None):
+    """
+    This function plots the road segments of a stored osm layer, and the nodes if nodes_path is given, like
+    ox.plot_graph did. Graphs with more than DECIMATE_EDGES edges are drawn decimated unless decimate says otherwise.
+    """
+    edges = read_columns(edges_path, ['geometry'])
+    if decimate is None:
+        decimate = len(edges) > DECIMATE_EDGES
+    if decimate:
+        segments = [np.array([g.coords[0], g.coords[-1]]) for g in edges['geometry'] if g is not None]
+    else:
+        segments = [np.asarray(g.coords) for g in edges['geometry'] if g is not None]
+    del edges
+    fig, ax = new_figure()
+    try:
+        draw_segments(ax, segments, decimate, '#999999', 1)
+        if nodes_path is not None and not decimate:
+            nodes = read_columns(nodes_path, ['geometry'])
+            ax.scatter([p.x for p in nodes['geometry']], [p.y for p in nodes['geometry']], s=15, c='#66ccff',
+                       edgecolors='none', zorder=2)
+        fig.savefig(path_fig, dpi=150 if decimate else 100)
+    finally:
+        fig.clear()
+    print('Stored plot of the OSM graph in ' + path_fig)
+
+
+def plot_gtfs(nodes_path, edges_path, path_fig, decimate=None):
+    """
+    This function plots the stops and connections of a stored GTFS layer, like ua.plot.plot_net did. Networks with more
+    than DECIMATE_EDGES edges are drawn without stops and rasterized unless decimate says otherwise.
+    """
+    nodes = read_columns(nodes_path, ['x', 'y'])
+    # The nodes are stored once per route serving the stop
+    nodes = nodes[~nodes.index.duplicated()]
+    edges = read_columns(edges_path, ['node_id_from', 'node_id_to'])
+    if decimate is None:
+        decimate = len(edges) > DECIMATE_EDGES
+    # Each connection is drawn once
+    pairs = edges[['node_id_from', 'node_id_to']].drop_duplicates()
+    pairs = pairs[pairs['node_id_from'].isin(nodes.index) & pairs['node_id_to'].isin(nodes.index)]
+    start = nodes.loc[pairs['node_id_from'], ['x', 'y']].to_numpy(dtype=float)
+    end = nodes.loc[pairs['node_id_to'], ['x', 'y']].to_numpy(dtype=float)
+    fig, ax = new_figure()
+    try:
+        draw_segments(ax, np.stack([start, end], axis=1), decimate, '#999999', 1)
+        if not decimate:
+            ax.scatter(nodes['x'], nodes['y'], s=15, c='#66ccff', edgecolors='none', zorder=2)
+        fig.savefig(path_fig, dpi=150 if decimate else 100)
+    finally:
+        fig.clear()
+    print('Stored plot of the GTFS graph in ' + path_fig)
@@ -9,143 +9,304 @@
 
 import numpy as np
 import math
+import ast
 import geopandas as gpd
 import os
-import shapefile
-from shapely.geometry.polygon import Polygon
+import json
+import hashlib
 import pandas as pd
-import censusdata
+from proj_sp_conradi import spatial_index
+from proj_sp_conradi import storage
+
+
+# Census Data API, and the number of variables per request (the API allows 50, one is NAME)
+ACS_URL = 'https://api.census.gov/data'
+ACS_BATCH = 49
+# Speed limits in kph for each road type, used for road segments without maxspeed
+HIGHWAY_SPEEDS = {'motorway': 60.0,
+                  'trunk_link': 50.0,
+                  'primary': 50.0,
+                  'primary_link': 50.0,
+                  'secondary': 50.0,
+                  'secondary_link': 50.0,
+                  'tertiary': 50.0,
+                  'tertiary_link': 50.0,
+                  'unclassified': 30.0,
+                  'residential': 30.0,
+                  'living_street': 20.0,
+                  'service': np.nan,
+                  'motorway_link': 50.0,
+                  'trunk': 80.0,
+                  'junction': 15.0,
+                  'bus_guideway': 15.0,
+                  'invalid': np.nan}
+# Speed limit in kph for road types that are not defined above
+DEFAULT_SPEED = 20.0
 
 
-def velocity_from_type(velocities_list, key, maxspeed):
+def kph2ms(v):
     """
-    This function matches roadsegment type with a speed limit.
+    This function converts velocity from kph to m/s.
     """
-    if math.isnan(maxspeed):
-        if key in velocities_list:
-            return kph2ms(velocities_list[key])
-        else:
-            print('The velocity for the road type ' + key + ' is not defined.')
-            return kph2ms(20.0)
-    else:
-        return kph2ms(maxspeed)
+    return v / 3.6
 
 
-def kph2ms(v):
+def tag_values(tag):
     """
-    This function converts velocity from kph to m/s.
+    This function returns the values of an OSM tag as tuple. Tags of merged road segments are lists, which become
+    strings like "['residential', 'tertiary']" when read back from csv.
     """
-    return v / 3.6
+    if isinstance(tag, (list, tuple)):
+        return tuple(str(t) for t in tag)
+    if isinstance(tag, str) and tag.startswith('['):
+        try:
+            return tuple(str(t) for t in ast.literal_eval(tag))
+        except (ValueError, SyntaxError):
+            pass
+    if tag is None or (isinstance(tag, float) and math.isnan(tag)) or tag == 'nan':
+        return ()
+    return (str(tag),)
+
+
+def parse_speed(value):
+    """
+    This function parses a single maxspeed value like '50' or '30 mph' to kph. Returns nan if it can't be parsed, e.g.
+    for 'CH:urban'.
+    """
+    value = value.strip().lower()
+    factor = 1.0
+    if value.endswith('mph'):
+        value = value[:-3].strip()
+        factor = 1.609344
+    try:
+        return float(value) * factor
+    except ValueError:
+        return np.nan
+
+
+def highway_speed(types):
+    """
+    This function returns the speed limit in kph for the road types of a segment. Segments that were merged from
+    several road types get the speed of the slowest type.
+    """
+    speeds = []
+    for t in types:
+        if t not in HIGHWAY_SPEEDS:
+            print('The velocity for the road type ' + t + ' is not defined.')
+        speeds.append(HIGHWAY_SPEEDS.get(t, DEFAULT_SPEED))
+    if not speeds:
+        return DEFAULT_SPEED
+    if all(math.isnan(v) for v in speeds):
+        return np.nan
+    return np.nanmin(speeds)
+
+
+def maxspeed_speed(values):
+    """
+    This function returns the maxspeed in kph of a segment. Segments that were merged from several segments get the
+    lowest maxspeed.
+    """
+    speeds = [parse_speed(v) for v in values]
+    speeds = [v for v in speeds if not math.isnan(v)]
+    return min(speeds) if speeds else np.nan
+
+
+def tag_lookup(tags, func):
+    """
+    This function parses each distinct value of a tag column only once. It returns func of each distinct value and the
+    code of each row into that table. Missing tags get code -1, the last entry of the table holds func of no values,
+    since depending on the pandas version astype(str) keeps them missing or turns them into 'nan'.
+    """
+    codes, uniques = pd.factorize(pd.Series(tags).astype(str))
+    table = np.array([func(tag_values(u)) for u in uniques] + [func(())], dtype=float)
+    return codes, table
 
 
 def get_speed_time(edges):
     """
-    This function appends the speed limit and the travel time for each road-segment.
-    """
-    v_dict = {'motorway': 60,
-              'trunk_link': 50,
-              'primary': 50.0,
-              'primary_link': 50.0,
-              'secondary': 50.0,
-              'secondary_link': 50.0,
-              'tertiary': 50.0,
-              'tertiary_link': 50.0,
-              'unclassified': 30.0,
-              'residential': 30.0,
-              'living_street': 20.0,
-              'service': np.nan,
-              'motorway_link': 50.0,
-              'trunk': 80.0,
-              # 'road': 25.0,
-              # additional: doesnt work like this..
-              '[residential, tertiary]': 25.0,
-              '[residential, unclassified]': 25.0,
-              '[secondary, tertiary]': 25.0,
-              '[primary, secondary]': 25.0,
-              'junction': 15.0,
-              '[residential, living_street]': 15.0,
-              '[motorway, motorway_link]': 35.0,
-              '[unclassified, tertiary]': 25.0,
-              '[motorway_link, trunk_link]': 20.0,
-              '[secondary, motorway_link]': 25.0,
-              '[residential, secondary_link]': 25.0,
-              '[primary, motorway_link]': 30.0,
-              '[residential, unclassified]': 30.0,
-              'bus_guideway ': 15.0,
-              'invalid': np.nan}
-
-    speed = []  # In m/s
-    time = []  # In sec
-    types = edges['highway']
-    length = edges['length']
-    maxspeed = edges['maxspeed']
-
-    for i in range(len(types)):
-        e = types[i]
-        if isinstance(maxspeed[i], list):
-            maxs = 20  # TODO exceptions?
-        else:
-            maxs = maxspeed[i]
-        speed.append(velocity_from_type(v_dict, str(e), float(maxs)))
-        time.append(length[i] / float(speed[i]))
+    This function appends the speed limit and the travel time for each road-segment. The maxspeed of a segment is used
+    if it has one, otherwise the speed of its road type.
+    """
+    highway_codes, highway_table = tag_lookup(edges['highway'], highway_speed)
+    if 'maxspeed' in edges:
+        maxspeed_codes, maxspeed_table = tag_lookup(edges['maxspeed'], maxspeed_speed)
+        maxspeed = maxspeed_table[maxspeed_codes]
+    else:
+        maxspeed = np.full(len(edges), np.nan)
+    speed = kph2ms(np.where(np.isnan(maxspeed), highway_table[highway_codes], maxspeed))  # In m/s
     edges['speed'] = speed
-    edges['time'] = time
+    edges['time'] = edges['length'].to_numpy(dtype=float) / speed  # In sec
 
     return edges
 
-def build_parking(edges, city, dirname):
+def read_parking_spots(dirname, city):
     """
-    This function adds the number of parking spots available at each road segment to egdes. Currently only for ZH.
+    This function reads the public parking spots and parking houses of a city. It returns the geometries and the number
+    of parking spots of each, which is 1 for each public parking spot.
     """
 
     # Directories
     addtional_info_path = 'resources/additional_info'
     open_parking_house_filename = 'oeffentliche_parkhaeser_' + city + '.json'
     open_parking_filename = 'oeffentliche_parkplätze_' + city + '.json'
-    output_filename = 'parking_' + city + '.csv'
     folder_path = os.path.join(dirname, addtional_info_path)
     open_parking_house_file_path = os.path.join(folder_path, open_parking_house_filename)
     open_parking_file_path = os.path.join(folder_path, open_parking_filename)
-    output_path = os.path.join(folder_path, output_filename)
     open_parking_df = gpd.read_file(open_parking_file_path)
     open_parking_house = gpd.read_file(open_parking_house_file_path)
-    edges['parking'] = np.zeros((len(edges['geometry'])))
 
-    print('adding parking spots to edges, this may take a while...')
+    geometry = list(open_parking_df['geometry']) + list(open_parking_house['geometry'])
+    spots = np.concatenate((np.ones(len(open_parking_df)),
+                            open_parking_house['anzahl_oeffentliche_pp'].to_numpy(dtype=float)))
+    return geometry, spots
 
-    # Find closest edge to parking spot for open parking
-    for i in range(len(open_parking_df['geometry'])):
-        dist = (edges['geometry']).distance(open_parking_df['geometry'][i])
-        edges.loc[dist.idxmin(), 'parking'] += 1
-    # Find closest edge to parking spot for parking houses
-    for i in range(len(open_parking_house['geometry'])):
-        dist = (edges['geometry']).distance(open_parking_house['geometry'][i])
-        edges.loc[dist.idxmin(), 'parking'] += open_parking_house['anzahl_oeffentliche_pp'][i]
 
-    parking = edges['parking']
-    parking.to_csv(output_path)
-    return edges
+def edge_identity(edges):
+    """
+    This function returns the (u, v, key) identity of each edge together with a hash of its geometry.
+    """
+    ids = pd.DataFrame({'u': edges['u'].to_numpy(dtype=np.int64),
+                        'v': edges['v'].to_numpy(dtype=np.int64),
+                        'key': edges['key'].to_numpy(dtype=np.int64) if 'key' in edges else 0})
+    ids['geometry_hash'] = [hashlib.sha1(g.wkb).hexdigest()[:16] for g in edges['geometry']]
+    return ids
+
+
+def identity_rank(ids):
+    """
+    This function returns the rank of each edge in the order of its (u, v, key) identity and geometry. Parking spots
+    that are equally close to several edges (e.g. both directions of a two-way street) go to the edge with the lowest
+    rank, so the assignment does not depend on the order of the edges.
+    """
+    order = np.lexsort([ids[column].to_numpy() for column in ['geometry_hash', 'key', 'v', 'u']])
+    rank = np.empty(len(ids), dtype=np.int64)
+    rank[order] = np.arange(len(ids))
+    return rank
+
+
+def parking_assignments(ids, nearest, dist, spots):
+    """
+    This function returns for each parking spot the identity of its closest edge, the distance to it and the number of
+    parking spots. Spots without edge get -1 as edge identity.
+    """
+    found = nearest >= 0
+    assignments = ids.iloc[np.where(found, nearest, 0)].reset_index(drop=True)
+    assignments.loc[~found, ['u', 'v', 'key']] = -1
+    assignments.loc[~found, 'geometry_hash'] = ''
+    assignments['dist'] = dist
+    assignments['spots'] = spots
+    return assignments
+
+
+def build_parking(edges, city, dirname):
+    """
+    This function assigns every parking spot to its closest road segment. Currently only for ZH.
+    """
+    geometry, spots = read_parking_spots(dirname, city)
+
+    print('adding parking spots to edges...')
+
+    # Find closest edge to each parking spot for open parking and parking houses
+    ids = edge_identity(edges)
+    nearest, dist = spatial_index.nearest_geometries(edges['geometry'], geometry, 0.0002, identity_rank(ids))
+    return parking_assignments(ids, nearest, dist, spots)
+
+
+def update_parking(edges, ids, old_ids, assignments, city, dirname):
+    """
+    This function updates cached parking assignments after the road network changed. Only spots whose edge was removed
+    or changed are assigned again from scratch. All other spots keep their edge unless a new or changed edge is closer.
+    """
+    key_cols = ['u', 'v', 'key', 'geometry_hash']
+    geometry, spots = read_parking_spots(dirname, city)
+    # Edges that are new or changed since the cached assignment
+    changed = ids.merge(old_ids[key_cols].drop_duplicates(), on=key_cols, how='left', indicator=True)
+    changed = np.flatnonzero((changed['_merge'] != 'both').to_numpy())
+    # Current position of the edge of each spot, nan if the edge is gone
+    positions = ids[key_cols].reset_index(drop=True).reset_index().rename(columns={'index': 'position'})
+    position = assignments[key_cols].merge(positions, on=key_cols, how='left')['position'].to_numpy()
+    lost = np.isnan(position)
+    nearest = np.where(lost, -1, np.nan_to_num(position, nan=-1)).astype(int)
+    dist = assignments['dist'].to_numpy(dtype=float, copy=True)
+    rank = identity_rank(ids)
+
+    print('updating parking spots of ' + str(len(changed)) + ' changed edges...')
+
+    if lost.any():
+        lost_pos = np.flatnonzero(lost)
+        nearest[lost_pos], dist[lost_pos] = spatial_index.nearest_geometries(
+            edges['geometry'], [geometry[i] for i in lost_pos], 0.0002, rank)
+    kept = np.flatnonzero(~lost)
+    if len(changed) and len(kept):
+        new_nearest, new_dist = spatial_index.nearest_geometries(
+            edges['geometry'].iloc[changed], [geometry[i] for i in kept], 0.0002, rank[changed])
+        # Ties go to the edge with the lowest rank, as in build_parking
+        new_rank = rank[changed[np.maximum(new_nearest, 0)]]
+        closer = (new_nearest >= 0) & ((new_dist < dist[kept]) |
+                                       ((new_dist == dist[kept]) & (new_rank < rank[nearest[kept]])))
+        nearest[kept[closer]] = changed[new_nearest[closer]]
+        dist[kept[closer]] = new_dist[closer]
+    return parking_assignments(ids, nearest, dist, spots)
 
 
 def get_parking(edges, dirname, city):
     """
-    This function adds the number of parking spots available at each road segment to egdes. It reads in from a
-    pre-computed csv. See get_parking.py for creation of csv.
+    This function adds the number of parking spots available at each road segment to egdes. The assignment of parking
+    spots to edges is cached in resources/additional_info/cache, keyed by the (u, v, key) identity and geometry of the
+    edges and by the hash of the parking files. If the road network changed, only the affected spots are assigned again.
+    If the parking files changed, everything is rebuilt.
     """
 
     # Directories
     addtional_info_path = 'resources/additional_info'
-    output_filename = 'parking_' + city + '.csv'
     folder_path = os.path.join(dirname, addtional_info_path)
-    output_path = os.path.join(folder_path, output_filename)
-
-    # Read in parking from csv
-    if os.path.isfile(output_path):
-        parking = pd.read_csv(output_path)
-        edges['parking'] = parking['0.0']
+    cache_path = os.path.join(folder_path, 'cache')
+    parking_paths = [os.path.join(folder_path, 'oeffentliche_parkplätze_' + city + '.json'),
+                     os.path.join(folder_path, 'oeffentliche_parkhaeser_' + city + '.json')]
+    legacy_path = os.path.join(folder_path, 'parking_' + city + '.csv')
+    meta_path = os.path.join(cache_path, 'parking_' + city + '.json')
+    assignments_path = os.path.join(cache_path, 'parking_' + city + '_assignments.parquet')
+    edges_path = os.path.join(cache_path, 'parking_' + city + '_edges.parquet')
+
+    if not all(os.path.isfile(path) for path in parking_paths):
+        # Pre-computed counts without edge identity, can only be used if the number of edges matches
+        if os.path.isfile(legacy_path):
+            parking = pd.read_csv(legacy_path, header=None, index_col=0)[1]
+            if len(parking) == len(edges):
+                print('Parking files not found, using the pre-computed counts in ' + legacy_path)
+                edges['parking'] = parking.to_numpy()
+                return edges
+        print('Error: No parking information found for ' + city)
         return edges
+
+    inputs = [storage.file_hash(path, cache_path) for path in parking_paths]
+    ids = edge_identity(edges)
+    graph = hashlib.sha1(pd.util.hash_pandas_object(ids, index=False).to_numpy().tobytes()).hexdigest()
+    meta = {}
+    if os.path.isfile(meta_path) and os.path.isfile(assignments_path) and os.path.isfile(edges_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if meta.get('inputs') == inputs and meta.get('graph') == graph:
+        print('Parking spots have already been assigned to this road network.')
+        assignments = storage.read_frame(assignments_path)
     else:
-        return build_parking(edges, city, dirname)
+        if meta.get('inputs') == inputs:
+            assignments = update_parking(edges, ids, storage.read_frame(edges_path), storage.read_frame(assignments_path),
+                                         city, dirname)
+        else:
+            assignments = build_parking(edges, city, dirname)
+        os.makedirs(cache_path, exist_ok=True)
+        storage.write_frame(assignments, assignments_path)
+        storage.write_frame(ids, edges_path)
+        with open(meta_path, 'w') as f:
+            json.dump({'inputs': inputs, 'graph': graph}, f)
+
+    # Sum up the spots per edge
+    key_cols = ['u', 'v', 'key', 'geometry_hash']
+    parking = assignments.groupby(key_cols, as_index=False)['spots'].sum()
+    parking = ids.merge(parking, on=key_cols, how='left')['spots'].fillna(0)
+    edges['parking'] = parking.to_numpy()
+    return edges
 
 
 def get_geom(dirname, city):
@@ -220,84 +381,129 @@ def get_geom(dirname, city):
 
     return merges
 
-def get_geom_us(dirname, city, county, state, var):
+def acs_request(base_url, dataset, year, state, county, variables):
     """
-    This function reads geografic regions and gets additional information for US cities and returns merged DataFrame
+    This function downloads variables of the American Community Survey for all tracts of a county with one request to
+    the Census Data API at base_url. Returns a DataFrame indexed like censusdata.download, e.g. 'Census Tract 73.12,
+    Douglas County, Nebraska: Summary level: 140, state:31> county:055> tract:007312'.
     """
+    import requests
 
-    geo = censusdata.censusgeo([('state', state), ('county', county), ('tract', '*')])
-    # var comes from user input, if not user did not input var
-    if var:
+    url = base_url.rstrip('/') + '/' + str(year) + '/acs/' + dataset
+    params = {'get': ','.join(['NAME'] + list(variables)), 'for': 'tract:*', 'in': 'state:' + state + ' county:' + county}
+    response = requests.get(url, params=params, timeout=60)
+    response.raise_for_status()
+    rows = response.json()
+    df = pd.DataFrame(rows[1:], columns=rows[0])
+    df.index = (df['NAME'] + ': Summary level: 140, state:' + df['state'] + '> county:' + df['county'] + '> tract:'
+                + df['tract']).to_numpy()
+    return df[list(variables)].apply(pd.to_numeric, errors='coerce')
+
+
+def download_acs(dirname, dataset, year, state, county, variables, base_url=ACS_URL):
+    """
+    This function returns variables of the American Community Survey for all tracts of a county. Responses are cached
+    in resources/additional_info/cache per dataset, year, state, county and variable, so only variables that were not
+    downloaded before are requested, at most ACS_BATCH per request.
+    """
+    # Directories
+    cache_dir = os.path.join(dirname, 'resources/additional_info/cache')
+    source = hashlib.sha1(base_url.encode()).hexdigest()[:8]
+    cache_path = os.path.join(cache_dir, '_'.join(['acs', dataset, str(year), state, county, source]) + '.parquet')
+    variables = list(dict.fromkeys(variables))
+    data = storage.read_frame(cache_path) if os.path.isfile(cache_path) else pd.DataFrame()
+    missing = [v for v in variables if v not in data.columns]
+    if not missing:
+        print('ACS variables found in cache ' + cache_path)
+        return data[variables]
+    print('Downloading ' + str(len(missing)) + ' ACS variables from ' + base_url)
+    for i in range(0, len(missing), ACS_BATCH):
+        batch = acs_request(base_url, dataset, year, state, county, missing[i:i + ACS_BATCH])
+        data = batch if data.empty else data.join(batch, how='outer')
+    os.makedirs(cache_dir, exist_ok=True)
+    storage.write_frame(data, cache_path)
+    return data[variables]
+
+
+def get_geom_us(dirname, city, county, state, var, base_url=None):
+    """
+    This function reads geografic regions and gets additional information for US cities and returns merged DataFrame.
+    The variables are downloaded from the Census Data API at base_url (by default ACS_URL), see download_acs.
+    """
+    # var are the further variables given by the user, either as list or comma-separated
+    if isinstance(var, str):
         var = var.split(",")
     # Default options
-    var = ['B01001_001E', 'B06011_001E', 'B25064_001E'] + var
+    var = ['B01001_001E', 'B06011_001E', 'B25064_001E'] + [v.strip() for v in var if v.strip()]
     # Download data from US Census Bureau
-    add_info = censusdata.download('acs5', 2015, geo, var)
+    add_info = download_acs(dirname, 'acs5', 2015, state, county, var, base_url or ACS_URL)
     # Get Tractindex from text
-    tractindex = []
-    for i in range(len(add_info)):
-        tract = str(add_info.index[i])
-        tractindex.append(tract.rsplit('tract:', 1)[1])
+    add_info['tractindex'] = add_info.index.str.rsplit('tract:', n=1).str[1]
     # Construct df with correct naming
-    add_info['tractindex'] = tractindex
     add_info = add_info.rename(columns={'B01001_001E': 'population'})
     add_info = add_info.rename(columns={'B06011_001E': 'income $/year'})
     add_info = add_info.rename(columns={'B25064_001E': 'median gross rent $/month'})
     return add_info
 
-def get_geo_node_us(dirname, points, state, county, simplify):
+def load_tracts(dirname, state, county):
     """
-        This function maps a each node to a geographic region. For US only.
+    This function returns the census tracts of a county as GeoDataFrame indexed by TRACTCE. Only the records of the
+    state's cb_2015_<state>_tract_500k shapefile are read to find the tracts of the county, and only their shapes are
+    decoded, with all parts and holes. The tracts of a county are cached as parquet in resources/additional_info/cache,
+    keyed by the content of the shapefile.
     """
+    import shapefile
+    from shapely.geometry import shape
+
     # Directories
-    shapepath = dirname + '/resources/additional_info/state_'+ state + '/cb_2015_'+state+'_tract_500k'
-    # Read in shapefile
-    sf = shapefile.Reader(shapepath)
-    Polygons = []
-    Tracts = []
-    shapes = sf.shapes()
-    records = sf.records()
-    tract = np.zeros(len(points))
+    shapepath = dirname + '/resources/additional_info/state_' + state + '/cb_2015_' + state + '_tract_500k'
+    cache_dir = os.path.join(dirname, 'resources/additional_info/cache')
+    key = storage.file_hash(shapepath + '.shp', cache_dir)[:16]
+    cache_path = os.path.join(cache_dir, 'tracts_' + state + '_' + county + '_' + key + '.parquet')
+    if os.path.isfile(cache_path):
+        return storage.read_frame(cache_path)
 
+    sf = shapefile.Reader(shapepath)
+    fields = [field[0] for field in sf.fields[1:]]
+    statefp, countyfp, tractce = [fields.index(name) for name in ['STATEFP', 'COUNTYFP', 'TRACTCE']]
+    # Tracts of the county from the attributes, before any geometry is read
+    selected = [(i, rec[tractce]) for i, rec in enumerate(sf.iterRecords())
+                if rec[statefp] == state and rec[countyfp] == county]
+    tracts = gpd.GeoDataFrame({'geometry': [shape(sf.shape(i).__geo_interface__) for i, _ in selected]},
+                              index=pd.Index([tract for _, tract in selected], name='tract'), geometry='geometry')
+    sf.close()
+    os.makedirs(cache_dir, exist_ok=True)
+    storage.write_frame(tracts, cache_path)
+    # Remove tracts cached from older versions of the shapefile
+    for name in os.listdir(cache_dir):
+        if name.startswith('tracts_' + state + '_' + county + '_') and name.endswith('.parquet') \
+                and name != os.path.basename(cache_path):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+    return tracts
+
+
+def get_geo_node_us(dirname, points, state, county):
+    """
+        This function maps a each node to a geographic region. For US only.
+    """
+    tracts = load_tracts(dirname, state, county)
     # Map each node to a tract
-    for i in range(len(shapes)):
-        shape = shapes[i]
-        rec = records[i]
-        if rec[0] == state and rec[1] == county:
-            Polygons.append(Polygon(shape.points))
-            Tracts.append(rec[2])
-    if simplify:
-        for i, point in enumerate(points):
-            for j, poly in enumerate(Polygons):
-                if poly.contains(point):
-                    tract[i] = Tracts[j]
-    else:
-        for i, point in enumerate(points['geometry']):
-            for j, poly in enumerate(Polygons):
-                if poly.contains(point):
-                    tract[i] = Tracts[j]
+    tract = spatial_index.assign_regions(spatial_index.node_geometry(points), tracts['geometry'], tracts.index)
 
     points['tract'] = tract
     return points
 
 
-def get_geo_node(points, geomdf, simplify):
+def get_geo_node(points, geomdf):
     """
     This function maps a each node to a geographic region.
     """
     polygons = geomdf['geometry']
     qnr = geomdf.index
-    tract = np.zeros(len(points))
 
-    if simplify:
-        for i, point in enumerate(points):
-            for j, poly in enumerate(polygons):
-                if poly.contains(point):
-                    tract[i] = qnr[j]
-    else:
-        for i, point in enumerate(points['geometry']):
-            for j, poly in enumerate(polygons):
-                if poly.contains(point):
-                    tract[i] = qnr[j]
+    tract = spatial_index.assign_regions(spatial_index.node_geometry(points), polygons, qnr)
     points['qnr'] = tract
     return points
\ No newline at end of file
@@ -0,0 +1,133 @@
+# -----------------------------------------------------------
+# This module runs the layers of one or several cities as a
+# dependency graph of tasks, independent tasks concurrently.
+#
+#
+# Johannes Conradi, 2020 ETH Zuerich
+# email: conradij@ethz.ch
+# -----------------------------------------------------------
+
+import os
+import time
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Task:
+    """
+    One step of the processing, e.g. the OSM layer of a city. func is called with args followed by the results of the
+    tasks in deps, in that order. If a dependency that is listed in optional fails, the task runs anyway and gets None
+    as its result. kind says where the task runs:
+    thread: in a thread of the main process, for downloads and other network or file bound steps
+    process: in the process pool, for CPU bound steps. func, args and result have to be picklable
+    isolated: in a new process of its own, for libraries with global state like urbanaccess
+    background: in one background process, for post-processing like plots. These tasks do not count towards the
+    concurrency limit, so they never hold up the processing.
+    """
+
+    def __init__(self, name, func, args=(), deps=(), kind='thread', optional=()):
+        if kind not in ['thread', 'process', 'isolated', 'background']:
+            raise ValueError('Unknown kind of task: ' + kind)
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.deps = list(deps)
+        self.kind = kind
+        self.optional = [dep for dep in optional if dep in self.deps]
+
+
+def run_isolated(func, args):
+    """
+    This function runs func in a new process and returns its result. The process is started with spawn, so it neither
+    inherits the state of the main process nor the state of earlier tasks. The process is not a daemon, so the task can
+    start processes of its own (e.g. the window workers of the GTFS layer).
+    """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(func, *args).result()
+
+
+def run_tasks(tasks, concurrency=1, processes=None):
+    """
+    This function runs the tasks in the order given by their dependencies. At most concurrency tasks run at the same
+    time, CPU bound tasks in a pool of processes processes (by default concurrency, at most one per CPU). With
+    concurrency 1 all tasks run one after the other, all but the isolated ones in the main thread. Tasks whose
+    dependencies failed are skipped, unless the dependencies are optional. Background tasks always run in a process of their own, one after the other.
+    Returns the results and the errors of the tasks, both by task name.
+    """
+    tasks = {task.name: task for task in tasks}
+    for task in tasks.values():
+        for dep in task.deps:
+            if dep not in tasks:
+                raise ValueError(task.name + ' depends on unknown task ' + dep)
+    results = {}
+    errors = {}
+    waiting = dict(tasks)
+    running = {}
+    start = {}
+    threads = ThreadPoolExecutor(max(concurrency, 1))
+    pool = None
+    if concurrency > 1 and any(task.kind == 'process' for task in tasks.values()):
+        pool = ProcessPoolExecutor(processes or min(concurrency, os.cpu_count()),
+                                   mp_context=multiprocessing.get_context('spawn'))
+    background = None
+    if any(task.kind == 'background' for task in tasks.values()):
+        background = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        while waiting or running:
+            # Skip tasks whose dependencies failed, also transitively
+            skipped = True
+            while skipped:
+                skipped = False
+                for name, task in list(waiting.items()):
+                    failed = [dep for dep in task.deps if dep in errors and dep not in task.optional]
+                    if failed:
+                        errors[name] = RuntimeError('skipped because ' + failed[0] + ' failed')
+                        print('Skipped ' + name + ', ' + failed[0] + ' failed')
+                        del waiting[name]
+                        skipped = True
+            # Start the tasks that are ready, in the order they were given
+            ready = [task for task in waiting.values() if all(dep in results or dep in errors for dep in task.deps)]
+            slots = max(concurrency, 1) - sum(tasks[name].kind != 'background' for name in running.values())
+            ready = [task for task in ready if task.kind == 'background'] + \
+                    [task for task in ready if task.kind != 'background'][:slots]
+            for task in ready:
+                del waiting[task.name]
+                args = task.args + tuple(results.get(dep) for dep in task.deps)
+                print('Started ' + task.name)
+                start[task.name] = time.perf_counter()
+                if task.kind == 'background':
+                    future = background.submit(task.func, *args)
+                elif task.kind == 'isolated':
+                    future = threads.submit(run_isolated, task.func, args)
+                elif concurrency <= 1:
+                    # Sequential run, the task runs right here in the main thread
+                    future = Future()
+                    try:
+                        future.set_result(task.func(*args))
+                    except Exception as e:
+                        future.set_exception(e)
+                elif task.kind == 'process':
+                    future = pool.submit(task.func, *args)
+                else:
+                    future = threads.submit(task.func, *args)
+                running[future] = task.name
+            if not running:
+                if waiting:
+                    raise ValueError('Cyclic dependencies between ' + ', '.join(waiting))
+                break
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    print('Finished ' + name + ' in %.1f s' % (time.perf_counter() - start[name]))
+                except Exception as e:
+                    errors[name] = e
+                    print('Error in ' + name + ': ' + repr(e))
+    finally:
+        threads.shutdown()
+        if pool is not None:
+            pool.shutdown()
+        if background is not None:
+            background.shutdown()
+    return results, errors
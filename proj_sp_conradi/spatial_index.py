@@ -0,0 +1,182 @@
+# -----------------------------------------------------------
+# This module provides spatial indices to map coordinates to
+# street layer nodes and regions in bulk.
+#
+#
+# Johannes Conradi, 2020 ETH Zuerich
+# email: conradij@ethz.ch
+# -----------------------------------------------------------
+
+import functools
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.spatial import cKDTree
+from pyproj import Transformer
+
+
+def node_geometry(points):
+    """
+    This function returns the geometry of the street layer nodes. It accepts both the GeoDataFrame of the unsimplified
+    graph and the GeoSeries of merged intersections of the simplified graph.
+    """
+    if isinstance(points, pd.DataFrame):
+        return points['geometry']
+    return points
+
+
+def node_coordinates(points):
+    """
+    This function returns the ids and the x/y coordinates of the street layer nodes, see node_geometry.
+    """
+    geometry = node_geometry(points)
+    x = np.array([point.x for point in geometry], dtype=float)
+    y = np.array([point.y for point in geometry], dtype=float)
+    return np.asarray(geometry.index), x, y
+
+
+class NodeIndex:
+    """
+    KD-tree over the street layer nodes. The tree is built once and then snaps whole coordinate arrays to the closest
+    node. Distances are measured in the coordinate frame of the nodes, i.e. the same way as
+    points['geometry'].distance(point) does, so the snapped node is the same as with a brute force search. If crs is
+    given (e.g. the UTM zone of the city), nodes and snapped coordinates are projected from lon/lat to crs first, so
+    distances are in meters.
+    """
+
+    def __init__(self, points, crs=None):
+        self.ids, x, y = node_coordinates(points)
+        self.crs = crs
+        if crs is not None:
+            x, y = transformer('epsg:4326', crs).transform(x, y)
+        self.tree = cKDTree(np.column_stack((x, y)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def snap(self, x, y):
+        """
+        This function returns the id of the closest node and the distance to it for each coordinate pair. Pairs with
+        missing or invalid coordinates get nan for both, as the old per trip search did.
+        """
+        x = pd.to_numeric(pd.Series(np.asarray(x)), errors='coerce').to_numpy(dtype=float)
+        y = pd.to_numeric(pd.Series(np.asarray(y)), errors='coerce').to_numpy(dtype=float)
+        valid = np.isfinite(x) & np.isfinite(y)
+        ids = np.full(len(x), np.nan)
+        dist = np.full(len(x), np.nan)
+        if valid.any():
+            query = np.column_stack((x[valid], y[valid]))
+            if self.crs is not None:
+                query = np.column_stack(transformer('epsg:4326', self.crs).transform(query[:, 0], query[:, 1]))
+            d, idx = self.tree.query(query)
+            ids[valid] = self.ids[idx]
+            dist[valid] = d
+        return ids, dist
+
+
+def bulk_query(tree, geoms):
+    """
+    This function returns the positions of all pairs of geoms and tree geometries whose bounding boxes intersect. The
+    R-tree of the tree GeoSeries is built on first use and kept by geopandas.
+    """
+    sindex = tree.sindex
+    if hasattr(sindex, 'query_bulk'):
+        return sindex.query_bulk(geoms)
+    return sindex.query(geoms)
+
+
+class RegionIndex:
+    """
+    R-tree over region polygons. The tree is built once and then assigns whole sets of points to the region that
+    contains them.
+    """
+
+    def __init__(self, polygons, labels):
+        self.polygons = gpd.GeoSeries(list(polygons))
+        self.labels = np.asarray(labels)
+        # Build the R-tree now, geopandas keeps it with the GeoSeries
+        self.polygons.sindex
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def assign(self, geometry):
+        """
+        This function returns for each point the label of the polygon that contains it and 0 for points that lie in no
+        polygon. Points on the boundary of a polygon are not contained in it. If polygons overlap, the point gets the
+        label of the last polygon, like the nested loop over all polygons did before.
+        """
+        points = gpd.GeoSeries(list(geometry))
+        region = np.zeros(len(points))
+        if len(points) == 0 or len(self.polygons) == 0:
+            return region
+        # Candidates from the R-tree, then exact test on the candidate pairs only
+        point_idx, poly_idx = bulk_query(self.polygons, points)
+        candidates = self.polygons.iloc[poly_idx].reset_index(drop=True)
+        inside = candidates.contains(points.iloc[point_idx].reset_index(drop=True)).to_numpy(dtype=bool)
+        last = np.full(len(points), -1)
+        np.maximum.at(last, point_idx[inside], poly_idx[inside])
+        hit = last >= 0
+        region[hit] = self.labels[last[hit]]
+        return region
+
+
+def assign_regions(geometry, polygons, labels):
+    """
+    This function assigns each point to the region that contains it, see RegionIndex.assign.
+    """
+    return RegionIndex(polygons, labels).assign(geometry)
+
+
+def nearest_geometries(tree, geoms, radius, rank=None):
+    """
+    This function returns for each geometry in geoms the position of the closest geometry in tree (e.g. the closest
+    road segment of a parking spot) and the distance to it. Candidates are searched with the R-tree of tree within
+    radius first. Geometries whose closest candidate lies further away are searched again within that distance,
+    geometries without any candidate within twice the radius. Ties go to the tree geometry with the lowest rank, by
+    default the first geometry of tree like Series.idxmin. Missing or empty geometries get -1 and nan.
+    """
+    tree = gpd.GeoSeries(list(tree))
+    geoms = gpd.GeoSeries(list(geoms))
+    nearest = np.full(len(geoms), -1)
+    dist = np.full(len(geoms), np.nan)
+    if len(tree) == 0:
+        return nearest, dist
+    rank = np.arange(len(tree)) if rank is None else np.asarray(rank)
+    todo = np.flatnonzero(~(geoms.isna() | geoms.is_empty).to_numpy())
+    search = np.full(len(geoms), float(radius))
+    while len(todo):
+        # Square buffers, their bounding boxes cover everything within the search radius
+        query = geoms.iloc[todo].buffer(search[todo], resolution=1, cap_style=3, join_style=2)
+        query_idx, tree_idx = bulk_query(tree, query)
+        d = tree.iloc[tree_idx].reset_index(drop=True).distance(
+            geoms.iloc[todo[query_idx]].reset_index(drop=True)).to_numpy()
+        # Closest candidate per geometry, lowest rank on ties
+        order = np.lexsort((rank[tree_idx], d, query_idx))
+        first = order[np.r_[True, query_idx[order][1:] != query_idx[order][:-1]]] if len(order) else order
+        # A candidate is only certain to be the closest if it lies within the search radius
+        closest = todo[query_idx[first]]
+        found = d[first] <= search[closest]
+        nearest[closest[found]] = tree_idx[first[found]]
+        dist[closest[found]] = d[first[found]]
+        search[todo] *= 2
+        search[closest[~found]] = d[first[~found]]
+        todo = np.setdiff1d(todo, closest[found])
+    return nearest, dist
+
+
+@functools.lru_cache(maxsize=None)
+def transformer(from_crs, to_crs):
+    """
+    This function returns a cached pyproj Transformer between two coordinate frames. Coordinates are always passed and
+    returned in x/y (lon/lat) order.
+    """
+    return Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+
+def utm_crs(lon, lat):
+    """
+    This function returns the UTM zone of a location as EPSG code, e.g. 'epsg:32632' for Zurich.
+    """
+    zone = int((lon + 180) // 6) % 60 + 1
+    return 'epsg:' + str((32600 if lat >= 0 else 32700) + zone)
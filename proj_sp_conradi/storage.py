@@ -0,0 +1,236 @@
+# -----------------------------------------------------------
+# This module provides helpers to store data frames in
+# columnar files and to key caches by file contents.
+#
+#
+# Johannes Conradi, 2020 ETH Zuerich
+# email: conradij@ethz.ch
+# -----------------------------------------------------------
+
+import os
+import json
+import threading
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import wkb
+
+# Key of the parquet metadata that lists the columns stored as JSON text
+META_KEY = b'proj_sp_conradi'
+
+
+def tmp_path_of(path):
+    """
+    Helper function, to get a temporary path next to path that is unique per process and thread, so concurrent writers
+    of the same file do not replace each other's temporary file
+    """
+    return path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+
+
+def file_hash(path, cache_dir=None):
+    """
+    This function returns the sha256 hex digest of a file. If cache_dir is given, digests are remembered there together
+    with size and modification time of the file, so unchanged files are not read again. Each file has its own entry
+    in cache_dir/hashes, written atomically, so processes hashing files in the same cache do not interfere. Entries
+    that cannot be read are ignored.
+    """
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    key = os.path.abspath(path)
+    if cache_dir is not None:
+        entry_path = os.path.join(cache_dir, 'hashes', hashlib.sha1(key.encode()).hexdigest() + '.json')
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            if entry['path'] == key and entry['stamp'] == stamp:
+                return entry['sha256']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    if cache_dir is not None:
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = tmp_path_of(entry_path)
+        with open(tmp_path, 'w') as f:
+            json.dump({'path': key, 'stamp': stamp, 'sha256': digest}, f)
+        os.replace(tmp_path, entry_path)
+    return digest
+
+
+def is_geometry(column):
+    """Helper function, to check if a column holds shapely geometries"""
+    return column.dtype.name == 'geometry'
+
+
+def column_kind(column):
+    """
+    Helper function, to check how an object column has to be stored. Returns 'list' for columns of lists and scalars
+    that all have the same element type (e.g. the OSM tags highway or lanes of merged road segments), 'json' for other
+    columns with lists or mixed types and None for plain columns.
+    """
+    if column.dtype != object:
+        return None
+    # Columns of only strings (e.g. ids in large GTFS tables) are recognised without a loop in Python
+    if pd.api.types.infer_dtype(column, skipna=True) in ['string', 'bytes', 'empty']:
+        return None
+    types = set()
+    has_list = False
+    for value in column:
+        if isinstance(value, (list, tuple)):
+            has_list = True
+            types.update(type(v) for v in value)
+        elif isinstance(value, (dict, set)):
+            return 'json'
+        elif not is_null(value):
+            types.add(type(value))
+    if has_list and len(types) <= 1 and types <= {str, int, float, bool}:
+        return 'list'
+    if has_list or len(types) > 1:
+        return 'json'
+    return None
+
+
+def is_null(value):
+    """Helper function, to check if a cell is missing"""
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def to_json(value):
+    """Helper function, to encode a cell as JSON text"""
+    if is_null(value):
+        return None
+    if isinstance(value, set):
+        value = sorted(value)
+    return json.dumps(value, default=lambda v: v.item() if hasattr(v, 'item') else str(v))
+
+
+def write_frame(df, path):
+    """
+    This function writes a DataFrame, GeoDataFrame or GeoSeries to a parquet file. Geometries are stored as WKB with
+    GeoParquet metadata, so the file can also be read with geopandas.read_parquet. Columns that mix lists and scalars
+    of one type (e.g. OSM tags like lanes or maxspeed) are stored as typed list columns, with scalars as lists of one
+    element. Columns with other mixed types are stored as JSON text. read_frame restores both. The file is replaced
+    atomically.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if isinstance(df, pd.Series):
+        df = gpd.GeoDataFrame({'geometry': df}) if is_geometry(df) else df.to_frame()
+    primary = df.geometry.name if isinstance(df, gpd.GeoDataFrame) and is_geometry(df[df.geometry.name]) else None
+    df = pd.DataFrame(df)
+    if df.index.dtype == object:
+        df.index = df.index.map(str)
+    geo_columns = {}
+    json_columns = []
+    list_columns = []
+    for column in df.columns:
+        if is_geometry(df[column]):
+            crs = gpd.GeoSeries(df[column]).crs
+            geo_columns[str(column)] = {'encoding': 'WKB', 'crs': crs.to_wkt() if crs is not None else None}
+            df[column] = [None if g is None else g.wkb for g in df[column]]
+        elif column_kind(df[column]) == 'list':
+            list_columns.append(str(column))
+            df[column] = [None if is_null(v) else list(v) if isinstance(v, (list, tuple)) else [v] for v in df[column]]
+        elif column_kind(df[column]) == 'json':
+            json_columns.append(str(column))
+            df[column] = [to_json(v) for v in df[column]]
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    metadata = dict(table.schema.metadata or {})
+    if geo_columns:
+        metadata[b'geo'] = json.dumps({'version': '0.1.0', 'primary_column': primary or list(geo_columns)[0],
+                                       'columns': geo_columns}).encode()
+    metadata[META_KEY] = json.dumps({'json_columns': json_columns, 'list_columns': list_columns}).encode()
+    table = table.replace_schema_metadata(metadata)
+    tmp_path = tmp_path_of(path)
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_frame(path, columns=None):
+    """
+    This function reads a parquet file written by write_frame. Only the given columns are read if columns is set.
+    Returns a GeoDataFrame if the file has geometry columns, otherwise a DataFrame.
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_pandas(path, columns=columns)
+    metadata = table.schema.metadata or {}
+    df = table.to_pandas()
+    own = json.loads(metadata[META_KEY]) if META_KEY in metadata else {}
+    for column in own.get('json_columns', []):
+        if column in df.columns:
+            df[column] = [np.nan if is_null(v) else json.loads(v) for v in df[column]]
+    for column in own.get('list_columns', []):
+        if column in df.columns:
+            df[column] = [np.nan if v is None else v[0] if len(v) == 1 else list(v) for v in df[column]]
+    if b'geo' not in metadata:
+        return df
+    geo = json.loads(metadata[b'geo'])
+    primary = None
+    for column, info in geo['columns'].items():
+        if column in df.columns:
+            df[column] = gpd.GeoSeries([None if is_null(v) else wkb.loads(bytes(v)) for v in df[column]],
+                                       index=df.index, crs=info.get('crs'))
+            if primary is None or column == geo['primary_column']:
+                primary = column
+    if primary is None:
+        return df
+    return gpd.GeoDataFrame(df, geometry=primary)
+
+
+def write_layer(df, path):
+    """
+    This function writes an output data set. The format is chosen by the file extension of path: parquet (see
+    write_frame) for .parquet, otherwise csv.
+    """
+    if path.endswith('.parquet'):
+        write_frame(df, path)
+    else:
+        df.to_csv(path)
+
+
+class LayerOutput:
+    """
+    Output data set of the street layer (nodes or edges) that is extended by several layers. The layers add their
+    columns in memory and the data set is written once by flush, either as one file or as the base file plus one
+    sidecar file per layer with only the columns added by that layer (e.g. osm_nodes_Zurich_region.parquet).
+    """
+
+    def __init__(self, frame, path):
+        self.frame = frame
+        self.path = path
+        self.base_columns = list(frame.columns)
+        self.layers = {}
+
+    def add(self, layer, frame):
+        """
+        This function takes the data set returned by a layer, or only the columns it added, and adds the new columns
+        to the data set. Layers that ran on copies of the data set can be added in any order.
+        """
+        known = self.base_columns + [c for columns in self.layers.values() for c in columns]
+        columns = [c for c in frame.columns if c not in known]
+        self.layers[layer] = self.layers.get(layer, []) + columns
+        for column in columns:
+            self.frame[column] = frame[column]
+
+    def sidecar_path(self, layer):
+        """Helper function, to get the path of the sidecar file of a layer"""
+        root, ext = os.path.splitext(self.path)
+        return root + '_' + layer + ext
+
+    def flush(self, sidecars=False):
+        """
+        This function writes the data set. With sidecars the base columns (including the geometry) and the columns of
+        each layer are written to separate files that share the index.
+        """
+        if not sidecars:
+            write_layer(self.frame, self.path)
+            return
+        write_layer(self.frame[self.base_columns], self.path)
+        for layer, columns in self.layers.items():
+            write_layer(pd.DataFrame(self.frame[columns]), self.sidecar_path(layer))
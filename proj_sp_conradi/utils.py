@@ -27,4 +27,14 @@ def valid_url_input(zip_url, urls):
     if zip_url in urls:
         return True
     else:
-        return False
\ No newline at end of file
+        return False
+
+def valid_windows_input(windows):
+    """Helper function, to check if input was valid"""
+    from proj_sp_conradi import gtfs_layer
+
+    try:
+        gtfs_layer.parse_windows(windows)
+        return True
+    except ValueError:
+        return False